@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# 同時に処理する生成リクエスト(/chat・/next-action など)の上限(0 で無制限)
+# Cloud Run の1インスタンス(1vCPU / 512Mi、container_concurrency = 80)を想定した値
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 16))
+# 上限を超えたリクエストを待たせておく数(これを超えると 429 を返す)
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 32))
+# 見込みの待ち時間がこの秒数を超える場合も待たせずに 429 を返す(0 で判定しない)
+ADMISSION_TARGET_LATENCY_SECONDS = float(os.getenv("ADMISSION_TARGET_LATENCY_SECONDS", 10))
+
+
+class Overloaded(Exception):
+    """
+    混雑のためリクエストを受け付けられない(retry_after 秒後の再試行を促す)
+    """
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is overloaded")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    同時に処理するリクエスト数を制限し、待ち行列が長くなりすぎる場合は即座に断る
+    待ち時間の見込みは (待ち行列の長さ + 1) × 平均処理時間 / 同時実行数 で見積もる
+    """
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int, target_latency: float):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.target_latency = target_latency
+        self.semaphore = asyncio.Semaphore(max(max_in_flight, 1))
+        self.in_flight = 0
+        self.waiting = 0
+        # 処理時間の指数移動平均(秒)
+        self.service_time = None
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_latency": 0}
+
+    def estimated_wait(self) -> float:
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return (self.waiting + 1) * (self.service_time or 1.0) / self.max_in_flight
+
+    def _reject(self, reason: str):
+        self.stats[f"rejected_{reason}"] += 1
+        retry_after = max(1, math.ceil(self.estimated_wait()))
+        logger.warning(f"Rejecting request to {self.name} ({reason}), retry after {retry_after}s")
+        raise Overloaded(self.name, retry_after)
+
+    async def acquire(self) -> float:
+        """
+        処理枠を確保し、開始時刻を返す(release に渡す)
+        """
+        if self.max_in_flight <= 0:
+            return time.perf_counter()
+        if self.in_flight >= self.max_in_flight or self.waiting:
+            if self.waiting >= self.max_queue:
+                self._reject("queue_full")
+            if self.target_latency > 0 and self.estimated_wait() > self.target_latency:
+                self._reject("latency")
+            self.stats["queued"] += 1
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+        return time.perf_counter()
+
+    def release(self, started: float):
+        if self.max_in_flight <= 0:
+            return
+        self.in_flight -= 1
+        self.semaphore.release()
+        elapsed = time.perf_counter() - started
+        self.service_time = elapsed if self.service_time is None else 0.8 * self.service_time + 0.2 * elapsed
+
+    @asynccontextmanager
+    async def admit(self):
+        started = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "service_time_ms_avg": round(self.service_time * 1000, 1) if self.service_time else None,
+            "estimated_wait_ms": round(self.estimated_wait() * 1000, 1),
+        }
+
+
+# 生成系のエンドポイントで共有する受付制御
+generation_admission = AdmissionController(
+    "generation", ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_TARGET_LATENCY_SECONDS
+)
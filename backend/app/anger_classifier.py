@@ -0,0 +1,126 @@
+import json
+import logging
+import math
+import random
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = Path(__file__).resolve().parent / "anger_model.json"
+CLASSES = [1, 2, 3, 4, 5]
+
+# 怒りを表す語と強さ(1: 苛立ち 〜 3: 激しい怒り)
+ANGER_LEXICON = {
+    "イラッ": 1, "イライラ": 1, "モヤモヤ": 1, "うんざり": 1, "面倒": 1, "不満": 1, "ムッ": 1,
+    "がっかり": 1, "納得いかない": 1, "ストレス": 1,
+    "腹が立": 2, "腹立": 2, "ムカつ": 2, "むかつ": 2, "うざ": 2, "ウザ": 2, "ありえない": 2,
+    "いい加減に": 2, "許せない": 2, "ふざけ": 2, "最悪": 2, "怒": 2, "我慢": 2, "限界": 2,
+    "キレ": 3, "キレそう": 3, "ブチ": 3, "ぶち": 3, "許さ": 3, "なめて": 3, "クソ": 3, "くそ": 3,
+    "殺": 3, "ぶっ壊": 3, "殴": 3, "死ね": 3, "激怒": 3, "煮えくり": 3, "ふざけんな": 3,
+}
+EXCLAMATION = re.compile(r"[！!]")
+REPEATED_EXCLAMATION = re.compile(r"[！!]{2,}")
+
+
+def extract_features(text: str) -> Dict[str, float]:
+    """
+    語彙の一致・感嘆符・文字n-gramを特徴量にする
+    """
+    features: Dict[str, float] = {"bias": 1.0}
+    for word, level in ANGER_LEXICON.items():
+        if word in text:
+            features[f"lex:{level}"] = features.get(f"lex:{level}", 0.0) + 1.0
+    features["excl"] = min(len(EXCLAMATION.findall(text)), 6) / 3
+    features["excl_repeat"] = min(len(REPEATED_EXCLAMATION.findall(text)), 3)
+    for n in (2, 3):
+        for i in range(len(text) - n + 1):
+            key = f"g{n}:{text[i:i + n]}"
+            features[key] = 1.0
+    return features
+
+
+def softmax(logits: List[float]) -> List[float]:
+    top = max(logits)
+    exps = [math.exp(v - top) for v in logits]
+    total = sum(exps)
+    return [v / total for v in exps]
+
+
+class AngerClassifier:
+    """
+    怒り度(1-5)を推定する線形モデル(多クラスロジスティック回帰)
+    重みは特徴量ごとに5クラス分のベクトルで持ち、出現した特徴量だけを足し合わせる
+    """
+
+    def __init__(self, weights: Dict[str, List[float]]):
+        self.weights = weights
+
+    @classmethod
+    def load(cls, path: Path = MODEL_PATH) -> Optional["AngerClassifier"]:
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f)["weights"])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Failed to load anger model: {e}")
+            return None
+
+    def save(self, path: Path = MODEL_PATH):
+        # 0に近い重みは保存しない(モデルファイルを小さく保つ)
+        weights = {
+            key: [round(w, 4) for w in vector]
+            for key, vector in self.weights.items()
+            if any(abs(w) >= 1e-3 for w in vector)
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"classes": CLASSES, "weights": weights}, f, ensure_ascii=False, sort_keys=True)
+
+    def probabilities(self, text: str) -> List[float]:
+        logits = [0.0] * len(CLASSES)
+        for key, value in extract_features(text).items():
+            vector = self.weights.get(key)
+            if vector is None:
+                continue
+            for i, w in enumerate(vector):
+                logits[i] += w * value
+        return softmax(logits)
+
+    def predict(self, text: str) -> Tuple[int, float]:
+        """
+        怒り度と確信度(最も確率の高いクラスの確率)を返す
+        """
+        probs = self.probabilities(text)
+        best = max(range(len(CLASSES)), key=probs.__getitem__)
+        return CLASSES[best], probs[best]
+
+
+def train(
+    samples: Iterable[Tuple[str, int]],
+    epochs: int = 60,
+    learning_rate: float = 0.2,
+    l2: float = 1e-4,
+    seed: int = 0,
+) -> AngerClassifier:
+    """
+    ラベル付きテキストからSGDで重みを学習する(オフラインの調整スクリプトから使う)
+    """
+    data = [(extract_features(text), CLASSES.index(label)) for text, label in samples]
+    weights: Dict[str, List[float]] = {}
+    rng = random.Random(seed)
+    for epoch in range(epochs):
+        rng.shuffle(data)
+        rate = learning_rate / (1 + epoch * 0.05)
+        for features, target in data:
+            logits = [0.0] * len(CLASSES)
+            for key, value in features.items():
+                vector = weights.setdefault(key, [0.0] * len(CLASSES))
+                for i, w in enumerate(vector):
+                    logits[i] += w * value
+            probs = softmax(logits)
+            for key, value in features.items():
+                vector = weights[key]
+                for i in range(len(CLASSES)):
+                    gradient = (probs[i] - (1.0 if i == target else 0.0)) * value
+                    vector[i] -= rate * (gradient + l2 * vector[i])
+    return AngerClassifier(weights)
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    複数のリクエストから届いた処理を短時間ためてまとめて実行し、結果をそれぞれに返す
+    最初の1件が届いてから max_wait 秒経つか、max_size 件たまった時点で実行する
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_size: int,
+        max_wait: float,
+    ):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.pending: List[tuple] = []
+        self.timer = None
+        self.tasks = set()
+        self.stats = {"batches": 0, "items": 0, "max_batch_size": 0, "flush_by_size": 0, "flush_by_wait": 0, "errors": 0}
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_size:
+            self.stats["flush_by_size"] += 1
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush_by_wait)
+        return await future
+
+    def _flush_by_wait(self):
+        self.stats["flush_by_wait"] += 1
+        self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch: List[tuple]):
+        self.stats["batches"] += 1
+        self.stats["items"] += len(batch)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Error in {self.name} batch: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def snapshot(self) -> dict:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "avg_batch_size": round(self.stats["items"] / batches, 2) if batches else 0,
+            "max_wait_ms": self.max_wait * 1000,
+            "max_size": self.max_size,
+        }
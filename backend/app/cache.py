@@ -0,0 +1,371 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# ワーカープロセス数(uvicorn の --workers の既定値と同じ WEB_CONCURRENCY で指定する)
+WORKERS = int(os.getenv("WEB_CONCURRENCY", 1))
+# キャッシュの保存先("memory": プロセスごとに保持 / "sqlite": 同じインスタンスのワーカー間で共有)
+# 複数ワーカーで動かす場合は、キャッシュを重複して持たないよう既定で sqlite にする
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite" if WORKERS > 1 else "memory")
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "/tmp/backend-cache.sqlite3")
+# 共有キャッシュの使用日時を更新する間隔(秒)
+SQLITE_CACHE_TOUCH_SECONDS = float(os.getenv("SQLITE_CACHE_TOUCH_SECONDS", 60))
+
+
+async def offload(func, *args, **kwargs):
+    """
+    キャッシュ・セッションの読み書きを呼び出す
+    SQLite の場合は他のワーカーの書き込みを待つことがあるため、イベントループを塞がないようスレッドで実行する
+    (メモリ上のキャッシュ・セッションはそのまま呼び出す)
+    """
+    if getattr(getattr(func, "__self__", None), "blocking", True):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def content_key(*parts) -> str:
+    """
+    キャッシュキーとなる値の組からハッシュ値を作る
+    """
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """
+    合成済み音声のキャッシュ
+    メモリ上のLRU(合計バイト数で上限を設ける)と、任意でディスク上の2段構成にする
+    スレッドプールから呼ばれるためロックで保護する
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        # ディスクを読み書きする場合は offload でスレッドから呼び出す
+        self.blocking = disk_dir is not None
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_size = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_size = sum(p.stat().st_size for p in self.disk_dir.glob("*.bin"))
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            audio = self.entries.get(key)
+            if audio is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return audio
+
+        audio = self._read_disk(key)
+        if audio is not None:
+            with self.lock:
+                self.stats["disk_hits"] += 1
+            self._put_memory(key, audio)
+            return audio
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, audio: bytes):
+        self._put_memory(key, audio)
+        self._write_disk(key, audio)
+
+    def _put_memory(self, key: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = audio
+            self.size += len(audio)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        path = self.disk_dir / f"{key}.bin"
+        try:
+            audio = path.read_bytes()
+            # 最近使ったものを残すため更新日時を使用日時として扱う
+            os.utime(path)
+            return audio
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Failed to read audio cache: {e}")
+            return None
+
+    def _write_disk(self, key: str, audio: bytes):
+        if not self.disk_dir or len(audio) > self.disk_max_bytes:
+            return
+        path = self.disk_dir / f"{key}.bin"
+        try:
+            if path.exists():
+                return
+            # 書き込み途中のファイルを読まれないよう一時ファイルからリネームする
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(audio)
+            tmp_path.replace(path)
+            with self.lock:
+                self.disk_size += len(audio)
+                over = self.disk_size > self.disk_max_bytes
+            if over:
+                self._evict_disk()
+        except OSError as e:
+            logger.warning(f"Failed to write audio cache: {e}")
+
+    def _evict_disk(self):
+        # 使用日時の古い順に上限の9割まで削除する
+        files = sorted(self.disk_dir.glob("*.bin"), key=lambda p: p.stat().st_mtime)
+        size = sum(p.stat().st_size for p in files)
+        for path in files:
+            if size <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                file_size = path.stat().st_size
+                path.unlink()
+                size -= file_size
+                with self.lock:
+                    self.stats["disk_evictions"] += 1
+            except OSError:
+                continue
+        with self.lock:
+            self.disk_size = size
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_size if self.disk_dir else 0,
+            }
+
+
+class TTLCache:
+    """
+    件数で上限を設けたLRUキャッシュ(各エントリには有効期限を設ける)
+    """
+
+    blocking = False
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: str):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key: str, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {**self.stats, "entries": len(self.entries), "max_items": self.max_items}
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中であれば、新たに実行せずその結果を待つ
+    """
+
+    def __init__(self):
+        self.inflight = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    async def run(self, key: str, func):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.stats["executed"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        # 待っている1リクエストがキャンセルされても、他のリクエストの処理は続ける
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task):
+        self.inflight.pop(key, None)
+        # 全員がキャンセルされた場合に例外が未取得の警告にならないよう取得しておく
+        if not task.cancelled():
+            task.exception()
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "inflight": len(self.inflight)}
+
+
+class SQLiteCache:
+    """
+    同じインスタンス内のワーカープロセス間で共有するキャッシュ(ローカルのSQLiteファイルに保持する)
+    件数・合計バイト数・有効期限で上限を設け、超えた場合は使用日時の古いものから削除する
+    bytes 以外の値は pickle して保存する
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, name: str, max_items: int = 0, max_bytes: int = 0, ttl: float = 0):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                pickled INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+            CREATE INDEX IF NOT EXISTS cache_entries_used_at ON cache_entries (name, used_at);
+            """
+        )
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, pickled, used_at FROM cache_entries WHERE name = ? AND key = ?"
+                " AND (expires_at IS NULL OR expires_at >= ?)",
+                (self.name, key, now),
+            ).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            # 読み出しのたびに書き込まないよう、使用日時は一定時間ごとにのみ更新する(LRUは近似になる)
+            if now - row[2] >= SQLITE_CACHE_TOUCH_SECONDS:
+                self.conn.execute(
+                    "UPDATE cache_entries SET used_at = ? WHERE name = ? AND key = ?", (now, self.name, key)
+                )
+            self.stats["hits"] += 1
+        value, pickled, _ = row
+        return pickle.loads(value) if pickled else bytes(value)
+
+    def put(self, key: str, value):
+        pickled = not isinstance(value, bytes)
+        data = pickle.dumps(value) if pickled else value
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (self.name, key, data, int(pickled), len(data), expires_at, now),
+                )
+                self._evict(now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float):
+        evicted = self.conn.execute(
+            "DELETE FROM cache_entries WHERE name = ? AND expires_at < ?", (self.name, now)
+        ).rowcount
+        if self.max_items:
+            evicted += self.conn.execute(
+                """
+                DELETE FROM cache_entries WHERE name = ? AND key IN (
+                    SELECT key FROM cache_entries WHERE name = ? ORDER BY used_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.name, self.name, self.max_items),
+            ).rowcount
+        if self.max_bytes:
+            # 新しいものから数えて合計バイト数が上限を超える分を削除する
+            evicted += self.conn.execute(
+                """
+                DELETE FROM cache_entries WHERE name = ? AND key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY used_at DESC) AS total
+                        FROM cache_entries WHERE name = ?
+                    ) WHERE total > ?
+                )
+                """,
+                (self.name, self.name, self.max_bytes),
+            ).rowcount
+        self.stats["evictions"] += evicted
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE name = ?", (self.name,)
+            ).fetchone()
+            return {
+                "backend": "sqlite",
+                **self.stats,
+                "entries": entries,
+                "bytes": size,
+                "max_items": self.max_items,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def create_audio_cache(name: str, max_bytes: int, disk_dir: Optional[str] = None, disk_max_bytes: int = 0):
+    """
+    音声のキャッシュを作成する(CACHE_BACKEND=sqlite の場合はワーカー間で共有する)
+    """
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteCache(SHARED_CACHE_PATH, name, max_bytes=max_bytes)
+    return AudioCache(max_bytes, disk_dir, disk_max_bytes)
+
+
+def create_ttl_cache(name: str, max_items: int, ttl: float):
+    """
+    有効期限付きのキャッシュを作成する(CACHE_BACKEND=sqlite の場合はワーカー間で共有する)
+    """
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteCache(SHARED_CACHE_PATH, name, max_items=max_items, ttl=ttl)
+    return TTLCache(max_items, ttl)
@@ -0,0 +1,247 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from cache import content_key
+
+logger = logging.getLogger(__name__)
+
+# 上流API(Gemini / Text-to-Speech)の呼び出しを記録・再生する(空: 無効 / record: 記録 / replay: 再生)
+UPSTREAM_CASSETTE = os.getenv("UPSTREAM_CASSETTE", "")
+# 記録先のディレクトリ(呼び出しごとの index.jsonl と、音声データを内容のハッシュ値で保存する audio/)
+UPSTREAM_CASSETTE_DIR = os.getenv("UPSTREAM_CASSETTE_DIR", "cassettes")
+# 再生時の速度(1: 記録時と同じ遅延 / 10: 10倍速 / 0: 待たずに返す)
+UPSTREAM_REPLAY_SPEED = float(os.getenv("UPSTREAM_REPLAY_SPEED", 1))
+
+
+class CassetteMiss(Exception):
+    """
+    再生時に、記録にない呼び出しが行われた
+    """
+
+
+def config_to_dict(generation_config) -> dict:
+    if generation_config is None:
+        return {}
+    if isinstance(generation_config, dict):
+        return generation_config
+    return generation_config.to_dict()
+
+
+def response_text(response) -> Optional[str]:
+    try:
+        return response.text
+    except ValueError:
+        # 安全性フィルタなどでテキストを含まない応答
+        return None
+
+
+def usage_to_dict(response) -> dict:
+    usage = getattr(response, "usage_metadata", None)
+    return {
+        "prompt_token_count": getattr(usage, "prompt_token_count", 0) or 0,
+        "candidates_token_count": getattr(usage, "candidates_token_count", 0) or 0,
+    }
+
+
+class ReplayResponse:
+    """
+    記録した応答(GenerativeModel の応答のうち、アプリで使う text と usage_metadata のみ)
+    """
+
+    def __init__(self, text: Optional[str], usage: Optional[dict] = None):
+        self._text = text
+        self.usage_metadata = SimpleNamespace(**(usage or {}))
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            raise ValueError("Response has no text")
+        return self._text
+
+
+class Cassette:
+    """
+    呼び出しの内容(モデル・プロンプト・生成設定、または音声合成のテキスト・形式)をキーに応答と遅延を記録する
+    同じキーの呼び出しが複数回記録されている場合は、記録された順に繰り返し返す
+    """
+
+    def __init__(self, mode: str, directory: str, speed: float):
+        self.mode = mode
+        self.directory = Path(directory)
+        self.audio_dir = self.directory / "audio"
+        self.index_path = self.directory / "index.jsonl"
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries: Dict[str, List[dict]] = {}
+        self.cursors: Dict[str, int] = {}
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+        if mode == "record":
+            self.audio_dir.mkdir(parents=True, exist_ok=True)
+        elif mode == "replay":
+            self.load()
+
+    def load(self):
+        with open(self.index_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"Loaded {sum(map(len, self.entries.values()))} upstream calls from {self.index_path}")
+
+    def append(self, entry: dict):
+        with self.lock:
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.stats["recorded"] += 1
+
+    def next_entry(self, key: str, description: str) -> dict:
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                self.stats["misses"] += 1
+                raise CassetteMiss(f"No recorded upstream call for {description}")
+            cursor = self.cursors.get(key, 0)
+            self.cursors[key] = cursor + 1
+            self.stats["replayed"] += 1
+            return entries[cursor % len(entries)]
+
+    def wait(self, seconds: float):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    # Gemini
+
+    def generate(self, label: str, func, prompt, generation_config=None, stream: bool = False, **kwargs):
+        prompt_text = prompt if isinstance(prompt, str) else str(prompt)
+        config = config_to_dict(generation_config)
+        key = content_key("generate", label, prompt_text, config, stream)
+        if self.mode == "replay":
+            entry = self.next_entry(key, f"model '{label}'")
+            if stream:
+                return self.replay_stream(entry)
+            self.wait(entry["latency"])
+            if entry.get("error"):
+                raise RuntimeError(entry["error"])
+            return ReplayResponse(entry["text"], entry.get("usage"))
+
+        entry = {"key": key, "kind": "generate", "model": label, "prompt": prompt_text, "config": config}
+        started = time.perf_counter()
+        if stream:
+            return self.record_stream(entry, started, func(prompt, generation_config=generation_config,
+                                                           stream=True, **kwargs))
+        try:
+            response = func(prompt, generation_config=generation_config, **kwargs)
+        except Exception as e:
+            self.append({**entry, "latency": round(time.perf_counter() - started, 4), "error": str(e)})
+            raise
+        self.append({
+            **entry,
+            "latency": round(time.perf_counter() - started, 4),
+            "text": response_text(response),
+            "usage": usage_to_dict(response),
+        })
+        return response
+
+    def record_stream(self, entry: dict, started: float, chunks):
+        # チャンクごとの到着時刻(呼び出し開始からの秒数)も記録する
+        # 読み出し側が途中でやめた場合(クライアントの切断や期限切れ)は、途中までの記録であることを残す
+        recorded = []
+        error = None
+        aborted = False
+        try:
+            for chunk in chunks:
+                recorded.append([round(time.perf_counter() - started, 4), response_text(chunk)])
+                yield chunk
+        except GeneratorExit:
+            aborted = True
+            raise
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.append({
+                **entry,
+                "latency": round(time.perf_counter() - started, 4),
+                "chunks": recorded,
+                "error": error,
+                "aborted": aborted,
+            })
+
+    def replay_stream(self, entry: dict):
+        elapsed = 0.0
+        for offset, text in entry.get("chunks", []):
+            self.wait(offset - elapsed)
+            elapsed = offset
+            yield ReplayResponse(text)
+        if entry.get("error"):
+            raise RuntimeError(entry["error"])
+        if entry.get("aborted"):
+            # 記録時は途中で読み出しをやめたため、続きの応答は記録にない
+            raise CassetteMiss(
+                f"Recorded stream for model '{entry['model']}' was aborted after {len(entry['chunks'])} chunks"
+            )
+
+    # Text-to-Speech
+
+    def synthesize(self, func, text: str, encoding: str, voice: dict) -> bytes:
+        key = content_key("synthesize", text, encoding, voice)
+        if self.mode == "replay":
+            entry = self.next_entry(key, "speech synthesis")
+            self.wait(entry["latency"])
+            if entry.get("error"):
+                raise RuntimeError(entry["error"])
+            return (self.audio_dir / entry["audio"]).read_bytes()
+
+        entry = {"key": key, "kind": "synthesize", "text": text, "encoding": encoding}
+        started = time.perf_counter()
+        try:
+            audio = func(text, encoding)
+        except Exception as e:
+            self.append({**entry, "latency": round(time.perf_counter() - started, 4), "error": str(e)})
+            raise
+        latency = time.perf_counter() - started
+        # 同じ音声は1回だけ保存する
+        name = hashlib.sha256(audio).hexdigest()
+        path = self.audio_dir / name
+        if not path.exists():
+            path.write_bytes(audio)
+        self.append({**entry, "latency": round(latency, 4), "audio": name})
+        return audio
+
+    def snapshot(self) -> dict:
+        return {"mode": self.mode, "directory": str(self.directory), "speed": self.speed, **self.stats}
+
+
+class CassetteModel:
+    """
+    GenerativeModel の generate_content を記録・再生に置き換える
+    再生時は元のモデルを持たず、それ以外の呼び出し(count_tokens など)は何もしない
+    """
+
+    def __init__(self, cassette: Cassette, label: str, model=None):
+        self.cassette = cassette
+        self.label = label
+        self.model = model
+
+    def generate_content(self, prompt, generation_config=None, stream: bool = False, **kwargs):
+        func = self.model.generate_content if self.model is not None else None
+        return self.cassette.generate(self.label, func, prompt, generation_config, stream, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        if self.model is not None:
+            return self.model.count_tokens(*args, **kwargs)
+        return None
+
+
+cassette = None
+if UPSTREAM_CASSETTE:
+    if UPSTREAM_CASSETTE not in ("record", "replay"):
+        raise RuntimeError(f"UPSTREAM_CASSETTE must be 'record' or 'replay', got {UPSTREAM_CASSETTE!r}")
+    cassette = Cassette(UPSTREAM_CASSETTE, UPSTREAM_CASSETTE_DIR, UPSTREAM_REPLAY_SPEED)
@@ -0,0 +1,69 @@
+import os
+from typing import Callable, List
+
+# プロンプトに含める会話履歴のトークン数の上限(目安)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+# 上限からあふれた古い発言を抜粋として残す分のトークン数
+CONTEXT_SUMMARY_TOKEN_BUDGET = int(os.getenv("CONTEXT_SUMMARY_TOKEN_BUDGET", 600))
+# 抜粋に残す1発言あたりの文字数
+CONTEXT_EXCERPT_CHARS = int(os.getenv("CONTEXT_EXCERPT_CHARS", 40))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数を概算する
+    日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字1トークンとして数える
+    """
+    if text.isascii():
+        return (len(text) + 3) // 4
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def build_context(
+    messages: List,
+    format_line: Callable[[object], str],
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    summary_budget: int = CONTEXT_SUMMARY_TOKEN_BUDGET,
+) -> str:
+    """
+    新しい発言から順に上限まではそのまま含め、それより古い発言は抜粋にまとめる
+    """
+    recent: List[str] = []
+    used = 0
+    index = len(messages)
+    # 新しい発言から上限まで残す(最新の発言は上限を超えても必ず含める)
+    while index > 0:
+        line = format_line(messages[index - 1])
+        cost = estimate_tokens(line) + 1
+        if recent and used + cost > budget:
+            break
+        recent.append(line)
+        used += cost
+        index -= 1
+    recent.reverse()
+
+    if index == 0:
+        return "\n".join(recent)
+
+    # 古い発言は先頭だけを抜粋し、新しいものから上限まで残す
+    excerpts: List[str] = []
+    used = 0
+    for message in reversed(messages[:index]):
+        line = format_line(message)
+        if len(line) > CONTEXT_EXCERPT_CHARS:
+            line = line[:CONTEXT_EXCERPT_CHARS] + "…"
+        cost = estimate_tokens(line) + 1
+        if used + cost > summary_budget:
+            break
+        excerpts.append(line)
+        used += cost
+    excerpts.reverse()
+    omitted = index - len(excerpts)
+    header = ["(以前の会話の抜粋)"]
+    if omitted:
+        header.append(f"(さらに古い{omitted}件の発言は省略)")
+    header.extend(excerpts)
+    header.append("(ここから直近の会話)")
+
+    return "\n".join(header + recent)
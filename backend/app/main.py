@@ -1,19 +1,24 @@
 import logging
-from typing import List, Optional
-from pydantic import BaseModel
-from fastapi import FastAPI, Depends, HTTPException, status
+from datetime import timedelta
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional
+from pydantic import BaseModel, Field, ValidationError
+from fastapi import FastAPI, Depends, Header, HTTPException, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.security import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
-import vertexai
-from vertexai.generative_models import GenerativeModel
+from fastapi.responses import JSONResponse, StreamingResponse
+import time
 import os
 from pathlib import Path
 from dotenv import load_dotenv, dotenv_values
 from random import randint
-from google.cloud import texttospeech
-import base64
 import asyncio
+import json
 from asyncio import gather
+from contextlib import aclosing, asynccontextmanager, contextmanager
+
+# Vertex AI SDK は読み込みに時間がかかるため、起動後の初期化時に読み込む
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerativeModel
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 # 環境変数の設定を関数化
@@ -35,25 +40,87 @@ def setup_environment():
 # アプリケーション初期化時に環境変数を設定
 config = setup_environment()
 
+# 以下のモジュールは読み込み時に環境変数を参照するため、環境変数の設定後に読み込む
+from upstream import hedged, run_upstream, tts_limit, upstream_executor, vertex_limit
+from admission import Overloaded, generation_admission
+from cassette import CassetteModel, cassette
+import metrics
+import tracing
+from tracing import current_timing, traced
+from metrics import (
+    MetricsMiddleware,
+    fallbacks,
+    model_seconds,
+    payload_bytes,
+    route_decisions,
+    stage_seconds,
+    upstream_errors,
+    upstream_seconds,
+)
+from anger_classifier import AngerClassifier
+from batching import MicroBatcher
+from cache import WORKERS, SingleFlight, content_key, create_ttl_cache, offload
+from context import build_context
+from speech import (
+    DEFAULT_AUDIO_ENCODING,
+    SentenceSplitter,
+    SpeechPipeline,
+    audio_store,
+    encode_audio,
+    generate_speech,
+    init_tts_clients,
+    load_audio,
+    store_audio,
+    tts_cache,
+    warm_up_tts_clients,
+)
+from sessions import MESSAGE_MAX_CHARS, SESSION_MAX_MESSAGES, session_store
+from routing import ModelRouter, load_routes
+from speculation import SPECULATION, SpeculativeReply, Speculator, count as count_speculation, speculation_stats
+
 # リクエストとレスポンスのスキーマ定義
 class Message(BaseModel):
     role: str  # "user" or "assistant"
-    content: str
+    content: str = Field(max_length=MESSAGE_MAX_CHARS)
 
 class ChatRequest(BaseModel):
     messages: List[Message]
     temperature: Optional[float] = 1.0
+    # 応答するキャラクター(未指定の場合はサーバーの既定値)
+    character: Optional[str] = None
+    # 音声の形式(未指定の場合はサーバーの既定値)
+    audio_encoding: Optional[Literal["LINEAR16", "MP3", "OGG_OPUS"]] = None
+    # "inline": audio にbase64で埋め込む / "id": audio_id を返し、/audio/{audio_id} で配信する
+    audio_delivery: Literal["inline", "id"] = "inline"
 
 class ChatResponse(BaseModel):
     response: str
     point: int
     progress: int 
     audio: str
+    audio_id: Optional[str] = None
+    audio_encoding: str = DEFAULT_AUDIO_ENCODING
+    # 期限内に終わらずデフォルト値を返した処理 ("speech" / "anger" / "progress" / "analysis")
+    degraded: List[str] = []
 
 class NextActionResponse(BaseModel):
     action: str
     reason: str
 
+class SessionResponse(BaseModel):
+    session_id: str
+
+class SessionChatRequest(BaseModel):
+    # 新しいユーザーメッセージのみ(それまでの履歴はサーバー側で保持する)
+    message: str = Field(max_length=MESSAGE_MAX_CHARS)
+    temperature: Optional[float] = 1.0
+    character: Optional[str] = None
+    audio_encoding: Optional[Literal["LINEAR16", "MP3", "OGG_OPUS"]] = None
+    audio_delivery: Literal["inline", "id"] = "inline"
+
+class SessionNextActionRequest(BaseModel):
+    temperature: Optional[float] = 1.0
+
 token = os.getenv("TOKEN")
 if not token:
     raise RuntimeError("TOKEN environment variable is not set")
@@ -66,7 +133,201 @@ def verify_token(auth_header: str = Depends(api_key_header)):
             detail="Invalid authentication token",
         )
     
-app = FastAPI( dependencies=[Depends(verify_token)],)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.getenv("PROJECT_ID")
+# 起動時に上流APIへの接続・認証を済ませておくか
+UPSTREAM_WARMUP = os.getenv("UPSTREAM_WARMUP", "1") != "0"
+UPSTREAM_WARMUP_TIMEOUT = float(os.getenv("UPSTREAM_WARMUP_TIMEOUT", 10))
+
+MODEL_NAME = "gemini-1.5-flash-002"
+# キャラクター設定をコンテキストキャッシュに載せ、リクエストごとに処理・課金されないようにするか
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 60 * 60))
+
+# 分析用のモデル(キャラクター設定なし)
+model = None
+# キャラクターごとの応答生成用モデル(キャラクター設定を system_instruction として持つ)
+chat_models: Dict[str, "GenerativeModel"] = {}
+# キャラクターごとのコンテキストキャッシュ(CONTEXT_CACHE=1 の場合のみ)
+context_caches = {}
+
+def init_vertex_model():
+    """
+    Vertex AI を初期化し、プロセス全体で共有するモデルを作成する
+    モデルはすべて作成し終えてから公開する(作成途中のモデルがリクエストから使われないように)
+    """
+    global model
+    if cassette and cassette.mode == "replay":
+        # 記録した応答を再生する場合は Vertex AI に接続しない
+        chat_models.update({name: CassetteModel(cassette, name) for name in CHARACTERS})
+        model = CassetteModel(cassette, "analysis")
+        return
+    if not PROJECT_ID:
+        logger.warning("PROJECT_ID environment variable is not set")
+    try:
+        import vertexai
+        from vertexai.generative_models import GenerativeModel
+
+        vertexai.init(project=PROJECT_ID, location="us-central1")
+        analysis_model = GenerativeModel(MODEL_NAME)
+        character_models = create_chat_models()
+    except Exception as e:
+        logger.error(f"Failed to initialize Vertex AI: {e}")
+        return
+    if cassette:
+        analysis_model = CassetteModel(cassette, "analysis", analysis_model)
+        character_models = {
+            name: CassetteModel(cassette, name, character_model)
+            for name, character_model in character_models.items()
+        }
+    chat_models.update(character_models)
+    model = analysis_model
+
+def create_chat_models() -> Dict[str, "GenerativeModel"]:
+    """
+    キャラクターごとに、設定を system_instruction に持つモデルを作成する
+    CONTEXT_CACHE=1 の場合はキャラクター設定をコンテキストキャッシュに載せたモデルを使う
+    """
+    from vertexai.generative_models import GenerativeModel
+
+    character_models = {}
+    for name in CHARACTERS:
+        instruction = character_instruction(name)
+        if CONTEXT_CACHE:
+            try:
+                from vertexai.preview import caching
+                from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
+
+                cached_content = caching.CachedContent.create(
+                    model_name=MODEL_NAME,
+                    system_instruction=instruction,
+                    ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+                    display_name=f"character-{name}",
+                )
+                character_models[name] = PreviewGenerativeModel.from_cached_content(cached_content=cached_content)
+                context_caches[name] = cached_content
+                continue
+            except Exception as e:
+                # キャッシュできる最小トークン数に満たない場合なども、system_instruction で動作させる
+                logger.warning(f"Failed to create context cache for character '{name}': {e}")
+        character_models[name] = GenerativeModel(MODEL_NAME, system_instruction=instruction)
+    return character_models
+
+async def refresh_context_caches():
+    """
+    コンテキストキャッシュが期限切れにならないよう、TTLの半分ごとに延長する
+    """
+    while True:
+        await asyncio.sleep(CONTEXT_CACHE_TTL_SECONDS / 2)
+        for name, cached_content in context_caches.items():
+            try:
+                await run_upstream(
+                    cached_content.update, ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+                )
+            except Exception as e:
+                logger.warning(f"Failed to refresh context cache for character '{name}': {e}")
+
+def delete_context_caches():
+    for name, cached_content in context_caches.items():
+        try:
+            cached_content.delete()
+        except Exception as e:
+            logger.warning(f"Failed to delete context cache for character '{name}': {e}")
+    context_caches.clear()
+
+def warm_up_vertex_model():
+    """
+    トークン数カウントを1回呼び、gRPCチャネルと認証トークンを準備しておく
+    """
+    if model:
+        model.count_tokens("warmup")
+
+async def warm_up_upstreams():
+    try:
+        await asyncio.wait_for(
+            gather(
+                run_upstream(warm_up_vertex_model),
+                run_upstream(warm_up_tts_clients),
+            ),
+            timeout=UPSTREAM_WARMUP_TIMEOUT,
+        )
+        logger.info("Upstream clients warmed up")
+    except Exception as e:
+        # ウォームアップに失敗しても起動は継続する(初回リクエストで再接続される)
+        logger.warning(f"Failed to warm up upstream clients: {e}")
+
+# 上流APIのクライアントの初期化を待たずにリクエストの受け付けを始めるか
+# (SDKの読み込み・クライアントの作成・ウォームアップはバックグラウンドで行い、完了は /ready で確認できる)
+STARTUP_BACKGROUND_INIT = os.getenv("STARTUP_BACKGROUND_INIT", "1") != "0"
+# 初期化中に届いたリクエストを、初期化の完了まで待たせる最大秒数(過ぎたら 503 を返す)
+STARTUP_WAIT_SECONDS = float(os.getenv("STARTUP_WAIT_SECONDS", 20))
+
+upstreams_ready = asyncio.Event()
+startup_state = {"vertex": False, "tts": False, "init_ms": None}
+# 起動時に開始したタスク(初期化・コンテキストキャッシュの延長)
+startup_tasks = set()
+
+async def init_upstreams():
+    """
+    上流APIのクライアントを作成してウォームアップする
+    SDKの読み込みとクライアントの作成はイベントループを塞がないようスレッドプールで行う
+    """
+    started = time.perf_counter()
+    try:
+        _, tts_error = await gather(
+            run_upstream(init_vertex_model), run_upstream(init_tts_clients), return_exceptions=True
+        )
+        if tts_error:
+            logger.error(f"Failed to initialize Text-to-Speech clients: {tts_error}")
+        startup_state["vertex"] = model is not None
+        startup_state["tts"] = tts_error is None
+        if UPSTREAM_WARMUP:
+            await warm_up_upstreams()
+    finally:
+        startup_state["init_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        upstreams_ready.set()
+    logger.info(f"Upstream clients initialized in {startup_state['init_ms']}ms")
+    if context_caches:
+        start_task(refresh_context_caches())
+
+def start_task(coro):
+    task = asyncio.create_task(coro)
+    startup_tasks.add(task)
+    task.add_done_callback(startup_tasks.discard)
+
+async def require_model():
+    """
+    初期化中であれば完了まで待ち、分析用のモデルが使えない場合は 503 を返す
+    """
+    if not upstreams_ready.is_set():
+        try:
+            await asyncio.wait_for(upstreams_ready.wait(), STARTUP_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Upstream clients are still starting")
+    if not model:
+        raise HTTPException(status_code=503, detail="Vertex AI model not initialized")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # クライアントはリクエストごとではなく起動時に1回だけ作成する
+    tracing.init_tracing()
+    if STARTUP_BACKGROUND_INIT:
+        start_task(init_upstreams())
+    else:
+        await init_upstreams()
+    yield
+    for task in list(startup_tasks):
+        task.cancel()
+    if context_caches:
+        await run_upstream(delete_context_caches)
+    upstream_executor.shutdown(wait=False, cancel_futures=True)
+    vertex_limit.shutdown()
+    tts_limit.shutdown()
+    tracing.shutdown_tracing()
+
+app = FastAPI(dependencies=[Depends(verify_token)], lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -74,29 +335,305 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # すべてのHTTPメソッドを許可
     allow_headers=["*"],  # すべてのヘッダーを許可
+    expose_headers=["Server-Timing"],  # 処理段階ごとの所要時間をフロントエンドから参照できるようにする
 )
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+app.add_middleware(MetricsMiddleware)
 
-# Vertex AI の初期化
-PROJECT_ID = os.getenv("PROJECT_ID")
-if not PROJECT_ID:
-    logger.warning("PROJECT_ID environment variable is not set")
+# /metrics 用のトークン(省略時は API と同じトークン)
+# Prometheus などには /chat を呼べないトークンを渡せるよう、API とは別に設定できる
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or token
+
+async def metrics_endpoint(request):
+    # グローバルな verify_token を通さないルートとして登録し、独自のトークンで認証する
+    if request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return JSONResponse(status_code=403, content={"detail": "Invalid authentication token"})
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+async def ready_endpoint(request):
+    """
+    上流APIのクライアントの初期化が終わり、Vertex AI を使える状態であれば 200、
+    初期化中または初期化に失敗した場合は 503 を返す(起動プローブ用、認証なし)
+    """
+    ready = upstreams_ready.is_set() and startup_state["vertex"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, **startup_state},
+    )
+
+app.add_route("/ready", ready_endpoint, include_in_schema=False)
+
+# 受付制御と上流APIの同時実行数は出力時に取得する
+metrics.Gauge(
+    "backend_admission_requests", "受付制御で処理中・待機中のリクエスト数", ("state",),
+    callback=lambda: {
+        ("in_flight",): generation_admission.in_flight,
+        ("waiting",): generation_admission.waiting,
+    },
+)
+metrics.Gauge(
+    "backend_upstream_calls", "上流APIごとの処理中・待機中の呼び出し数", ("upstream", "state"),
+    callback=lambda: {
+        (limit.name, state): getattr(limit, state)
+        for limit in (vertex_limit, tts_limit)
+        for state in ("in_flight", "waiting")
+    },
+)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    # 混雑時は待たせずに断り、再試行までの秒数を返す
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
-try:
-    vertexai.init(project=PROJECT_ID, location="us-central1")
-    model = GenerativeModel("gemini-1.5-flash-002")
-except Exception as e:
-    logger.error(f"Failed to initialize Vertex AI: {e}")
-    model = None
 
 
+# タスク(chat / anger / progress など)ごとの呼び出し回数・レイテンシ・トークン数
+usage_stats = {}
+
+def record_usage(task: str, started: float, response=None, error: bool = False):
+    stats = usage_stats.setdefault(task, {
+        "calls": 0, "errors": 0, "latency_ms_total": 0.0, "prompt_tokens": 0, "output_tokens": 0,
+    })
+    elapsed = time.perf_counter() - started
+    stats["calls"] += 1
+    stats["errors"] += int(error)
+    stats["latency_ms_total"] += elapsed * 1000
+    upstream_seconds.labels(task=task).observe(elapsed)
+    if error:
+        upstream_errors.labels(task=task).inc()
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+        stats["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+# 処理ごとの期限(秒、0 で無制限)
+# 応答生成が期限を過ぎた場合は 504 を返し、それ以外の処理はデフォルト値で応答を返す
+DEADLINE_GENERATION_SECONDS = float(os.getenv("DEADLINE_GENERATION_SECONDS", 25))
+DEADLINE_SPEECH_SECONDS = float(os.getenv("DEADLINE_SPEECH_SECONDS", 8))
+DEADLINE_ANGER_SECONDS = float(os.getenv("DEADLINE_ANGER_SECONDS", 4))
+DEADLINE_PROGRESS_SECONDS = float(os.getenv("DEADLINE_PROGRESS_SECONDS", 4))
+
+# タスク(応答生成・怒り度・進捗度・次のアクション)ごとのモデルの振り分け
+# 候補が複数ある場合、1回の呼び出しの期限は既定で処理の期限を候補数で割った値にする(期限内に次の候補を試せるように)
+model_router = ModelRouter(load_routes(MODEL_NAME, {
+    "chat": DEADLINE_GENERATION_SECONDS,
+    "anger": DEADLINE_ANGER_SECONDS,
+    "progress": DEADLINE_PROGRESS_SECONDS,
+}))
+# 振り分けで選んだ、既定以外のモデル(モデル名・キャラクターごとに初回に作成する)
+routed_models = {}
+
+metrics.Gauge(
+    "backend_route_latency_seconds", "タスク・モデルごとに観測したレイテンシの移動平均", ("task", "model"),
+    callback=lambda: {key: stats.latency for key, stats in model_router.stats.items()},
+)
+metrics.Gauge(
+    "backend_route_error_ratio", "タスク・モデルごとに観測したエラー率の移動平均", ("task", "model"),
+    callback=lambda: {key: stats.error_rate for key, stats in model_router.stats.items()},
+)
+
+def routed_model(model_name: str, character: Optional[str], default):
+    """
+    振り分けで選んだモデル名に対応するモデルを返す(既定のモデル名であれば default を使う)
+    """
+    if model_name == MODEL_NAME:
+        return default
+    key = (model_name, character)
+    if key not in routed_models:
+        label = f"{model_name}/{character or 'analysis'}"
+        if cassette and cassette.mode == "replay":
+            routed_models[key] = CassetteModel(cassette, label)
+        else:
+            from vertexai.generative_models import GenerativeModel
+
+            instruction = character_instruction(character) if character else None
+            generative_model = GenerativeModel(model_name, system_instruction=instruction)
+            routed_models[key] = CassetteModel(cassette, label, generative_model) if cassette else generative_model
+    return routed_models[key]
+
+async def call_model(task: str, prompt: str, generation_config, target_model=None, character: Optional[str] = None):
+    """
+    Geminiを呼び出し、タスクごとのレイテンシとトークン数を記録する
+    target_model を省略した場合は分析用のモデルを使う
+    振り分け対象のタスクは、選んだモデルで失敗・期限切れになった場合に次の候補で呼び直す
+    """
+    route = model_router.routes.get(task)
+    if route is None:
+        return await call_upstream_model(task, prompt, generation_config, target_model or model)
+
+    names, reason = model_router.choose(task)
+    for attempt, name in enumerate(names):
+        route_decisions.labels(task=task, model=name, reason=reason if attempt == 0 else "fallback").inc()
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                call_upstream_model(
+                    task,
+                    prompt,
+                    route.generation_config(generation_config),
+                    routed_model(name, character, target_model or model),
+                    name,
+                ),
+                route.timeout if route.timeout > 0 else None,
+            )
+        except asyncio.CancelledError:
+            # 処理の期限切れやヘッジで外から打ち切られた場合は、モデルの遅延・失敗とは限らないため
+            # 振り分けの統計には含めず、所要時間だけ記録して中断する
+            elapsed = time.perf_counter() - started
+            model_seconds.labels(task=task, model=name, outcome="cancelled").observe(elapsed)
+            raise
+        except Exception as e:
+            elapsed = time.perf_counter() - started
+            outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+            model_router.record(task, name, elapsed, error=True)
+            model_seconds.labels(task=task, model=name, outcome=outcome).observe(elapsed)
+            if attempt == len(names) - 1:
+                raise
+            logger.warning(f"Model '{name}' failed for task '{task}' ({outcome}), falling back: {e!r}")
+            continue
+        elapsed = time.perf_counter() - started
+        model_router.record(task, name, elapsed, error=False)
+        model_seconds.labels(task=task, model=name, outcome="ok").observe(elapsed)
+        return response
+
+async def call_upstream_model(task: str, prompt: str, generation_config, target_model, model_name: str = MODEL_NAME):
+    """
+    1つのモデルを1回呼び出す
+    """
+    started = time.perf_counter()
+    with tracing.span("gemini.generate_content", task=task, model=model_name, prompt_chars=len(prompt)) as current:
+        try:
+            response = await vertex_limit.run(
+                target_model.generate_content, prompt, generation_config=generation_config
+            )
+        except Exception:
+            record_usage(task, started, error=True)
+            raise
+        record_usage(task, started, response)
+        if current is not None:
+            try:
+                tracing.set_attributes(current, output_chars=len(response.text))
+            except ValueError:
+                # 安全性フィルタなどでテキストを含まない応答
+                tracing.set_attributes(current, output_chars=0)
+    return response
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
-CHAT_SETTINGS = {
+@app.get("/characters")
+def list_characters():
+    """
+    選択できるキャラクターと、コンテキストキャッシュの利用状況を返す
+    """
+    return {
+        "default": DEFAULT_CHARACTER,
+        "characters": [
+            {"name": name, "context_cache": name in context_caches} for name in CHARACTERS
+        ],
+    }
+
+@app.get("/stats/usage")
+def usage_stats_endpoint():
+    """
+    Geminiの呼び出し回数・平均レイテンシ・トークン数をタスクごとに返す
+    """
+    return {
+        "analysis_mode": ANALYSIS_MODE,
+        "anger_scorer": {"mode": ANGER_SCORER, **anger_scorer_stats},
+        "deadlines": deadline_stats,
+        "speculation": speculation_stats,
+        "routing": model_router.snapshot(),
+        "cassette": cassette.snapshot() if cassette else None,
+        "admission": generation_admission.snapshot(),
+        "upstream_limits": {limit.name: limit.snapshot() for limit in (vertex_limit, tts_limit)},
+        "batching": {
+            batcher.name: batcher.snapshot()
+            for batcher in (anger_batcher, progress_batcher) if batcher
+        },
+        "tasks": {
+            task: {**stats, "latency_ms_avg": round(stats["latency_ms_total"] / stats["calls"], 2)}
+            for task, stats in usage_stats.items()
+        },
+    }
+
+@app.get("/cache/stats")
+def cache_stats():
+    """
+    キャッシュのヒット・ミス・追い出し回数とサイズを返す(キャッシュサイズの調整用)
+    """
+    return {
+        "tts": tts_cache.snapshot(),
+        "audio_store": audio_store.snapshot(),
+        "sessions": session_store.snapshot(),
+        "prefetched_actions": prefetched_actions.snapshot(),
+        "next_action": {**next_action_cache.snapshot(), **next_action_flight.snapshot()},
+    }
+
+def parse_range(range_header: str, size: int):
+    """
+    Rangeヘッダー(単一範囲のみ対応)を解析して (開始, 終了) を返す
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            # 末尾からの指定 (bytes=-500)
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        return None
+    return first, min(last, size - 1)
+
+@app.get("/audio/{audio_id}")
+def get_audio(audio_id: str, range_header: Optional[str] = Header(None, alias="Range")):
+    """
+    /chat で audio_delivery="id" を指定した場合の音声データを返す(Rangeリクエスト対応)
+    """
+    stored = load_audio(audio_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    audio, media_type = stored
+    headers = {
+        "Accept-Ranges": "bytes",
+        # IDは内容のハッシュ値なので内容が変わることはない
+        "Cache-Control": "private, max-age=3600, immutable",
+    }
+    if range_header is None:
+        return Response(content=audio, media_type=media_type, headers=headers)
+
+    byte_range = parse_range(range_header, len(audio))
+    if byte_range is None:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{len(audio)}"},
+        )
+    start, end = byte_range
+    return Response(
+        content=audio[start:end + 1],
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{len(audio)}"},
+    )
+
+# キャラクター設定(応答生成用モデルの system_instruction になる)
+CHARACTERS = {
+    "aniki": {
     "character": """
     あなたはハキハキ明るく親しみやすい兄貴肌の頼れるアシスタントです
     以下の特徴を持っています：
@@ -111,27 +648,92 @@ CHAT_SETTINGS = {
     ユーザは強い怒りを持って話しかけてきます
     """,
     "format": "ユーザが置かれた状況を引き出し、状況を把握しながら建設的な提案をしてください"
+    },
+    "counselor": {
+    "character": """
+    あなたは穏やかで落ち着いた聞き上手のカウンセラーです
+    以下の特徴を持っています：
+    - 話し方は丁寧(です・ます調)で、相手の言葉を否定せずに受け止める
+    - 相手の感情に名前をつけて言葉にし、気持ちの整理を手伝う
+    - 人間になりきって回答する(characterとして与えられた設定をそのまま相手に伝えない)
+    - 回答は1~4文程度の長さとする
+    
+    返答の際は必ず上記の性格設定を維持してください。
+    ユーザは強い怒りを持って話しかけてきます
+    """,
+    "format": "ユーザの気持ちを受け止めたうえで状況を引き出し、無理のない次の一歩を一緒に考えてください"
+    },
 }
+DEFAULT_CHARACTER = os.getenv("DEFAULT_CHARACTER", "aniki")
 
-async def analyze_anger_level(text: str) -> int:
+def character_instruction(name: str) -> str:
+    settings = CHARACTERS[name]
+    return f"{settings['character']}\n{settings['format']}"
+
+def get_chat_model(character: Optional[str]):
     """
-    テキストの怒り度合いを1-5で評価する
+    キャラクターに対応する応答生成用モデルを返す
     """
-    analysis_prompt = """
-    以下のテキストの怒りの度合いを1から5の整数で評価してください。
+    name = character or DEFAULT_CHARACTER
+    if name not in CHARACTERS:
+        raise HTTPException(status_code=400, detail=f"Unknown character: {name}")
+    chat_model = chat_models.get(name)
+    if not chat_model:
+        raise HTTPException(status_code=503, detail="Vertex AI model not initialized")
+    return chat_model
+
+# 怒り度の評価方法 ("llm": 毎回Geminiで評価 / "local": ローカルの分類器で評価し、確信度が低い場合のみGeminiで評価)
+ANGER_SCORER = os.getenv("ANGER_SCORER", "llm")
+ANGER_LOCAL_MIN_CONFIDENCE = float(os.getenv("ANGER_LOCAL_MIN_CONFIDENCE", 0.7))
+anger_classifier = AngerClassifier.load() if ANGER_SCORER == "local" else None
+anger_scorer_stats = {"local": 0, "fallback": 0}
+
+# 怒り度の評価基準
+ANGER_CRITERIA = """
     評価基準:
     1: ほとんど怒りなし
     2: 軽い苛立ち
     3: 明確な怒り
     4: 強い怒り
     5: 激怒
-    
+    """
+
+# 複数リクエストの怒り度・進捗度の評価を短時間ためて1回の呼び出しにまとめるか
+SCORING_BATCH = os.getenv("SCORING_BATCH", "0") == "1"
+SCORING_BATCH_MAX_SIZE = int(os.getenv("SCORING_BATCH_MAX_SIZE", 16))
+# 最初の1件が届いてからまとめて実行するまでの最大待ち時間(ミリ秒)
+SCORING_BATCH_MAX_WAIT_MS = float(os.getenv("SCORING_BATCH_MAX_WAIT_MS", 10))
+
+async def analyze_anger_level(text: str) -> int:
+    """
+    テキストの怒り度合いを1-5で評価する
+    """
+    if anger_classifier:
+        level, confidence = anger_classifier.predict(text)
+        if confidence >= ANGER_LOCAL_MIN_CONFIDENCE:
+            anger_scorer_stats["local"] += 1
+            return level
+        anger_scorer_stats["fallback"] += 1
+
+    if anger_batcher:
+        try:
+            return await anger_batcher.submit(text)
+        except Exception:
+            fallbacks.labels(stage="anger", reason="error").inc()
+            return 3  # エラー時はデフォルト値として中間の3を返す
+    return await score_anger(text)
+
+async def score_anger(text: str) -> int:
+    analysis_prompt = f"""
+    以下のテキストの怒りの度合いを1から5の整数で評価してください。
+    {ANGER_CRITERIA}
     返答は数字のみにしてください。
 
     テキスト: """
     
     try:
-        response = model.generate_content(
+        response = await call_model(
+            "anger",
             analysis_prompt + text,
             generation_config={
                 "temperature": 0.1,  # より決定論的な結果を得るため
@@ -144,18 +746,46 @@ async def analyze_anger_level(text: str) -> int:
         return max(1, min(5, anger_level))
     except Exception as e:
         logger.error(f"Error in anger analysis: {e}")
+        fallbacks.labels(stage="anger", reason="error").inc()
         return 3  # エラー時はデフォルト値として中間の3を返す
 
-async def analyze_progress(messages: List[Message]) -> int:
+async def score_batch(task: str, instruction: str, items: List[str]) -> List[int]:
     """
-    会話履歴から悩み解決の進捗度を0-100で評価する
+    番号付きの複数項目を1回の呼び出しで評価し、入力順の整数の配列を返す
     """
-    if not messages:
-        return 0
-        
-    analysis_prompt = """
-    以下の会話履歴から、悩みの解決進捗度を1から5の整数で評価してください。
-    
+    from vertexai.generative_models import GenerationConfig
+
+    numbered = "\n\n".join(f"[{i + 1}]\n{item}" for i, item in enumerate(items))
+    response = await call_model(
+        task,
+        f"{instruction}\n    結果は入力と同じ順番で、{len(items)}個の整数のJSON配列で返してください。\n\n{numbered}",
+        generation_config=GenerationConfig(
+            temperature=0.1,
+            max_output_tokens=8 * len(items) + 32,
+            response_mime_type="application/json",
+            response_schema={"type": "ARRAY", "items": {"type": "INTEGER"}},
+        ),
+    )
+    scores = json.loads(response.text)
+    if not isinstance(scores, list) or len(scores) != len(items):
+        raise ValueError(f"expected {len(items)} scores, got {response.text!r}")
+    return [int(score) for score in scores]
+
+async def score_anger_batch(texts: List[str]) -> List[int]:
+    if len(texts) == 1:
+        return [await score_anger(texts[0])]
+    instruction = f"""
+    以下の各テキストの怒りの度合いを、それぞれ1から5の整数で評価してください。
+    {ANGER_CRITERIA}"""
+    try:
+        return [max(1, min(5, score)) for score in await score_batch("anger_batch", instruction, texts)]
+    except Exception as e:
+        # まとめての評価に失敗した場合は1件ずつ評価する
+        logger.error(f"Error in batched anger analysis: {e}")
+        return list(await gather(*(score_anger(text) for text in texts)))
+
+# 進捗度の評価基準(全履歴での評価と、要約を使った差分評価で共通)
+PROGRESS_CRITERIA = """
     評価基準:
     1: 問題が明確になっていない、または解決への糸口が見えていない
     2: 問題は明確だが、解決策がまだ見つかっていない
@@ -164,16 +794,22 @@ async def analyze_progress(messages: List[Message]) -> int:
     5: 解決に向けて具体的な行動計画が立てられている、または問題が解決している
     
     返答は数字のみにしてください。
-    
-    会話履歴:
     """
-    
-    # 会話履歴をフォーマット
-    conversation = "\n".join([f"{'ユーザー' if msg.role == 'user' else 'アシスタント'}: {msg.content}" for msg in messages])
-    
+
+def format_analysis_line(msg: Message) -> str:
+    return f"{'ユーザー' if msg.role == 'user' else 'アシスタント'}: {msg.content}"
+
+def format_conversation(messages: List[Message]) -> str:
+    """
+    分析用に会話履歴をフォーマットする(トークン数の上限を超える古い発言は抜粋にまとめる)
+    """
+    return build_context(messages, format_analysis_line)
+
+async def score_progress(prompt: str) -> int:
     try:
-        response = model.generate_content(
-            analysis_prompt + conversation,
+        response = await call_model(
+            "progress",
+            prompt,
             generation_config={
                 "temperature": 0.1,
                 "max_output_tokens": 10,
@@ -185,116 +821,816 @@ async def analyze_progress(messages: List[Message]) -> int:
         return max(0, min(100, progress))
     except Exception as e:
         logger.error(f"Error in progress analysis: {e}")
+        fallbacks.labels(stage="progress", reason="error").inc()
         return 50  # エラー時はデフォルト値として中間の50を返す
 
+async def analyze_progress(messages: List[Message]) -> int:
+    """
+    会話履歴から悩み解決の進捗度を0-100で評価する
+    """
+    if not messages:
+        return 0
+        
+    analysis_prompt = f"""
+    以下の会話履歴から、悩みの解決進捗度を1から5の整数で評価してください。
+    {PROGRESS_CRITERIA}
+    会話履歴:
+    """
+    
+    # 会話履歴をフォーマット
+    conversation = format_conversation(messages)
+    if progress_batcher:
+        try:
+            return await progress_batcher.submit(conversation)
+        except Exception:
+            fallbacks.labels(stage="progress", reason="error").inc()
+            return 50  # エラー時はデフォルト値として中間の50を返す
+    return await score_progress(analysis_prompt + conversation)
 
-# Text-to-Speech機能を実装する関数
-async def generate_speech(text: str) -> str:
+async def score_progress_batch(conversations: List[str]) -> List[int]:
+    analysis_prompt = f"""
+    以下の会話履歴から、悩みの解決進捗度を1から5の整数で評価してください。
+    {PROGRESS_CRITERIA}
+    会話履歴:
+    """
+    if len(conversations) == 1:
+        return [await score_progress(analysis_prompt + conversations[0])]
+    instruction = f"""
+    以下の各会話履歴について、悩みの解決進捗度をそれぞれ1から5の整数で評価してください。
+    {PROGRESS_CRITERIA}"""
     try:
-        # Text-to-Speech クライアントを初期化
-        client = texttospeech.TextToSpeechClient()
+        return [max(0, min(100, score)) for score in await score_batch("progress_batch", instruction, conversations)]
+    except Exception as e:
+        # まとめての評価に失敗した場合は1件ずつ評価する
+        logger.error(f"Error in batched progress analysis: {e}")
+        return list(await gather(*(score_progress(analysis_prompt + c) for c in conversations)))
 
-        # 合成する入力テキストを設定
-        synthesis_input = texttospeech.SynthesisInput(text=text)
+anger_batcher = progress_batcher = None
+if SCORING_BATCH:
+    anger_batcher = MicroBatcher(
+        "anger", score_anger_batch, SCORING_BATCH_MAX_SIZE, SCORING_BATCH_MAX_WAIT_MS / 1000
+    )
+    progress_batcher = MicroBatcher(
+        "progress", score_progress_batch, SCORING_BATCH_MAX_SIZE, SCORING_BATCH_MAX_WAIT_MS / 1000
+    )
 
-        # 音声パラメータを設定
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="ja-JP",
-            name="ja-JP-Neural2-D"
-        )
+async def analyze_progress_incremental(meta: dict, exchange: List[Message]) -> int:
+    """
+    これまでの会話の要約と直近のやりとりだけから進捗度を評価する
+    会話が長くなってもプロンプトの長さが一定に保たれる
+    """
+    analysis_prompt = f"""
+    以下の「これまでの会話の要約」「前回の評価」「直近のやりとり」から、悩みの解決進捗度を1から5の整数で評価してください。
+    {PROGRESS_CRITERIA}
+    これまでの会話の要約:
+    {meta.get("summary") or "なし"}
 
-        # オーディオ設定
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.LINEAR16,
-            effects_profile_id=["small-bluetooth-speaker-class-device"],
-            pitch=-8.0,
-            speaking_rate=1.3
-        )
+    前回の評価: {meta.get("progress", "なし")}
 
-        # リクエストを実行
-        response = client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
+    直近のやりとり:
+    """
+    return await score_progress(
+        analysis_prompt + format_conversation(meta_messages(meta) + exchange)
+    )
+
+def meta_messages(meta: dict) -> List[Message]:
+    """
+    要約にまだ反映されていないやりとりを返す
+    """
+    return [Message(**msg) for msg in meta.get("unsummarized", [])]
+
+async def update_progress_summary(session_id: str):
+    """
+    要約に未反映のやりとりを要約に取り込む(応答後にバックグラウンドで実行する)
+    """
+    meta = await offload(session_store.get_meta, session_id)
+    pending = meta.get("unsummarized", [])
+    if not pending:
+        return
+    summary_prompt = f"""
+    以下の「これまでの要約」に「新しいやりとり」の内容を反映し、更新した要約を出力してください。
+    ユーザーの悩みの内容・状況・提示された解決策・それに対するユーザーの反応が分かるように、300文字以内でまとめてください。
+
+    これまでの要約:
+    {meta.get("summary") or "なし"}
+
+    新しいやりとり:
+    """
+    try:
+        response = await call_model(
+            "summary",
+            summary_prompt + format_conversation([Message(**msg) for msg in pending]),
+            generation_config={
+                "temperature": 0.1,
+                "max_output_tokens": 512,
+            },
         )
+        summary = response.text.strip()
+    except Exception as e:
+        logger.error(f"Error in progress summary update: {e}")
+        return
+    # 要約中に追加されたやりとりは残しておき、次回の要約に回す
+    # (その間に古いものが上限で切り捨てられていても取り違えないよう、件数ではなく通し番号で判定する)
+    summarized = max(msg.get("seq", 0) for msg in pending)
+    latest = await offload(session_store.get_meta, session_id)
+    latest["summary"] = summary
+    latest["unsummarized"] = [msg for msg in latest.get("unsummarized", []) if msg.get("seq", 0) > summarized]
+    await offload(session_store.set_meta, session_id, latest)
+
+# 怒り度・進捗度・次のアクションの分析方法
+# "separate": それぞれ個別にGeminiへ問い合わせる / "combined": 応答生成後に1回の構造化出力(JSON)でまとめて取得する
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "separate")
+# combined モードで得た次のアクションを /next-action で返すために保持する件数と秒数
+PREFETCHED_ACTION_MAX_ITEMS = int(os.getenv("PREFETCHED_ACTION_MAX_ITEMS", 1000))
+PREFETCHED_ACTION_TTL_SECONDS = int(os.getenv("PREFETCHED_ACTION_TTL_SECONDS", 30 * 60))
+prefetched_actions = create_ttl_cache("prefetched_actions", PREFETCHED_ACTION_MAX_ITEMS, PREFETCHED_ACTION_TTL_SECONDS)
+
+# 次のアクションを提案できなかった場合のデフォルト
+DEFAULT_NEXT_ACTION = ("状況の整理と冷静な分析", "現状をより明確に把握するため")
 
-        # 音声データをbase64エンコード
-        audio_base64 = base64.b64encode(response.audio_content).decode('utf-8')
-        return audio_base64
+COMBINED_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "anger": {"type": "INTEGER"},
+        "progress": {"type": "INTEGER"},
+        "action": {"type": "STRING"},
+        "reason": {"type": "STRING"},
+    },
+    "required": ["anger", "progress", "action", "reason"],
+}
+
+def conversation_key(messages: List[Message]) -> str:
+    return content_key([(msg.role, msg.content) for msg in messages])
+
+async def analyze_combined(messages: List[Message]) -> dict:
+    """
+    怒り度(1-5)・進捗度・次のアクションを1回の呼び出しでまとめて評価する
+    """
+    analysis_prompt = f"""
+    以下の会話履歴を分析し、次の項目をJSONで返してください。
 
+    anger: 最後のユーザー発言の怒りの度合い(1から5の整数)
+    {ANGER_CRITERIA}
+    progress: 悩みの解決進捗度(1から5の整数)
+    {PROGRESS_CRITERIA}
+    action: ユーザーが次に取るべき具体的な行動
+    reason: そのアクションを提案する理由
+
+    会話履歴:
+    """
+    from vertexai.generative_models import GenerationConfig
+
+    try:
+        response = await call_model(
+            "combined",
+            analysis_prompt + format_conversation(messages),
+            generation_config=GenerationConfig(
+                temperature=0.1,
+                max_output_tokens=512,
+                response_mime_type="application/json",
+                response_schema=COMBINED_ANALYSIS_SCHEMA,
+            ),
+        )
+        result = json.loads(response.text)
+        action = str(result.get("action") or "").strip()
+        reason = str(result.get("reason") or "").strip()
+        if not action or not reason:
+            action, reason = DEFAULT_NEXT_ACTION
+        return {
+            # 怒り度は1-5、進捗度は0-100の範囲に収める
+            "anger": max(1, min(5, int(result["anger"]))),
+            "progress": max(0, min(100, int(result["progress"]))),
+            "action": action,
+            "reason": reason,
+        }
     except Exception as e:
-        logger.error(f"Error in speech generation: {e}")
-        return ""
+        logger.error(f"Error in combined analysis: {e}")
+        fallbacks.labels(stage="analysis", reason="error").inc()
+        # エラー時は個別の分析と同じデフォルト値を返す
+        action, reason = DEFAULT_NEXT_ACTION
+        return {"anger": 3, "progress": 50, "action": action, "reason": reason}
+
+async def analyze_turn(messages: List[Message], updated_messages: List[Message]) -> dict:
+    """
+    combined モードで応答後の会話を評価し、次のアクションを /next-action 用に保持しておく
+    """
+    analysis = await analyze_combined(updated_messages)
+    # 最後のメッセージがユーザー発言でない場合は怒り度を評価しない(個別の分析と同じ扱い)
+    if not (messages and messages[-1].role == "user"):
+        analysis["anger"] = 1
+    await offload(
+        prefetched_actions.put, conversation_key(updated_messages), (analysis["action"], analysis["reason"])
+    )
+    return analysis
+
+def build_chat_prompt(messages: List[Message]) -> str:
+    """
+    会話履歴から応答生成用のプロンプトを作成する
+    キャラクター設定はモデルの system_instruction として渡すため含めない
+    """
+    # 会話履歴をフォーマット(トークン数の上限を超える古い発言は抜粋にまとめる)
+    formatted_history = build_context(messages, format_chat_line)
+    return "".join([formatted_history, "\nAssistant: " if messages else "Assistant: "])
+
+def format_chat_line(msg: Message) -> str:
+    role_prefix = "User: " if msg.role == "user" else "Assistant: "
+    return f"{role_prefix}{msg.content}"
+
+def start_anger_task(messages: List[Message]) -> asyncio.Task:
+    """
+    怒り度分析タスクを開始する（最後のユーザーメッセージがある場合のみ）
+    応答テキストに依存しないため、テキスト生成と同時に開始できる
+    """
+    if messages and messages[-1].role == "user":
+        return asyncio.create_task(analyze_anger_level(messages[-1].content))
+    return asyncio.create_task(asyncio.sleep(0))  # ダミータスク
+
+# 応答生成がこの秒数で返らなければ同じ呼び出しをもう1つ開始し、早い方を使う(0 で無効)
+GENERATION_HEDGE_AFTER_SECONDS = float(os.getenv("GENERATION_HEDGE_AFTER_SECONDS", 0))
+deadline_stats = {"generation_timeouts": 0, "hedged": 0, "degraded": {}}
+
+async def with_deadline(stage: str, awaitable, timeout: float, default, degraded: List[str]):
+    """
+    期限内に終わらなければ処理を打ち切り、デフォルト値を返して degraded に記録する
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout if timeout > 0 else None)
+    except asyncio.TimeoutError:
+        logger.warning(f"Stage '{stage}' missed its deadline of {timeout}s")
+        degraded.append(stage)
+        deadline_stats["degraded"][stage] = deadline_stats["degraded"].get(stage, 0) + 1
+        fallbacks.labels(stage=stage, reason="deadline").inc()
+        return default
+
+@contextmanager
+def timed_stage(endpoint: str, stage: str):
+    """
+    処理段階の所要時間をメトリクスと Server-Timing に記録し、スパンを返す
+    """
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"{endpoint}.{stage}") as current:
+            yield current
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.labels(endpoint=endpoint, stage=stage).observe(elapsed)
+        timing = current_timing.get()
+        if timing is not None:
+            timing.add(stage, elapsed)
+
+async def timed(endpoint: str, stage: str, awaitable):
+    with timed_stage(endpoint, stage):
+        return await awaitable
+
+def json_response(endpoint: str, body: BaseModel) -> Response:
+    """
+    レスポンスをJSONに変換し、変換時間とサイズを記録する
+    """
+    with timed_stage(endpoint, "serialize") as current:
+        content = body.model_dump_json()
+        tracing.set_attributes(current, response_bytes=len(content))
+    payload_bytes.labels(endpoint=endpoint, kind="response").observe(len(content))
+    headers = {}
+    timing = current_timing.get()
+    if timing is not None:
+        headers["Server-Timing"] = timing.header()
+    return Response(content=content, media_type="application/json", headers=headers)
+
+async def generate_reply(chat_model, prompt: str, temperature: Optional[float], character: Optional[str] = None):
+    """
+    応答テキストを生成する(期限とヘッジ付き)
+    """
+    def count_hedge():
+        deadline_stats["hedged"] += 1
+
+    try:
+        return await asyncio.wait_for(
+            hedged(
+                lambda: call_model(
+                    "chat",
+                    prompt,
+                    generation_config={
+                        "temperature": temperature,
+                        "max_output_tokens": 1024,
+                    },
+                    target_model=chat_model,
+                    character=character or DEFAULT_CHARACTER,
+                ),
+                GENERATION_HEDGE_AFTER_SECONDS,
+                on_hedge=count_hedge,
+            ),
+            DEADLINE_GENERATION_SECONDS if DEADLINE_GENERATION_SECONDS > 0 else None,
+        )
+    except asyncio.TimeoutError:
+        deadline_stats["generation_timeouts"] += 1
+        raise HTTPException(status_code=504, detail="Response generation timed out")
 
 @app.post("/chat", response_model=ChatResponse)
+@traced("chat")
 async def chat(request: ChatRequest):
-    if not model:
-        raise HTTPException(status_code=503, detail="Vertex AI model not initialized")
+    async with generation_admission.admit():
+        return json_response("chat", await generate_chat(request))
+
+async def generate_chat(request: ChatRequest, progress_scorer=analyze_progress) -> ChatResponse:
+    """
+    応答テキスト・音声・怒り度・進捗度を生成する
+    progress_scorer には応答を含む会話履歴から進捗度を返す関数を渡す
+    """
+    await require_model()
+    chat_model = get_chat_model(request.character)
     
     try:
-        # システムプロンプトを作成
-        system_prompt = f"{CHAT_SETTINGS['character']}\n{CHAT_SETTINGS['format']}\n\n"
-        
-        # 会話履歴をフォーマット
-        formatted_history = system_prompt
-        for msg in request.messages:
-            role_prefix = "User: " if msg.role == "user" else "Assistant: "
-            formatted_history += f"{role_prefix}{msg.content}\n"
-        
-        formatted_history += "Assistant: "
+        with timed_stage("chat", "prompt"):
+            formatted_history = build_chat_prompt(request.messages)
+        combined = ANALYSIS_MODE == "combined"
+        degraded: List[str] = []
 
-        # テキスト応答を生成（これは他のタスクの依存元なので先に実行）
-        response = model.generate_content(
-            formatted_history,
-            generation_config={
-                "temperature": request.temperature,
-                "max_output_tokens": 1024,
-            },
-        )
+        # 怒り度分析はテキスト生成と同時に開始する(combined モードでは応答後にまとめて分析する)
+        anger_task = None if combined else asyncio.create_task(timed("chat", "anger", with_deadline(
+            "anger", start_anger_task(request.messages), DEADLINE_ANGER_SECONDS, 3, degraded
+        )))
+
+        # テキスト応答を生成（音声生成・進捗度分析の依存元）
+        try:
+            response = await timed("chat", "generate", generate_reply(
+                chat_model, formatted_history, request.temperature, request.character
+            ))
+        except Exception:
+            if anger_task:
+                anger_task.cancel()
+            raise
 
         # 新しい応答を含むメッセージリストを作成
         updated_messages = request.messages + [
             Message(role="assistant", content=response.text)
         ]
 
-        # 並列実行する独立したタスクを準備
-        tasks = []
-        
-        # 音声生成タスク
-        tasks.append(generate_speech(response.text))
-        
-        # 怒り度分析タスク（最後のユーザーメッセージがある場合のみ）
-        if request.messages and request.messages[-1].role == "user":
-            tasks.append(analyze_anger_level(request.messages[-1].content))
+        # 音声生成・進捗度分析を怒り度分析と並列実行
+        audio_encoding = request.audio_encoding or DEFAULT_AUDIO_ENCODING
+        speech = timed("chat", "speech", with_deadline(
+            "speech", generate_speech(response.text, audio_encoding), DEADLINE_SPEECH_SECONDS, b"", degraded
+        ))
+        if combined:
+            audio_data, analysis = await gather(
+                speech,
+                timed("chat", "analysis", with_deadline(
+                    "analysis",
+                    analyze_turn(request.messages, updated_messages),
+                    max(DEADLINE_ANGER_SECONDS, DEADLINE_PROGRESS_SECONDS),
+                    {"anger": 3, "progress": 50},
+                    degraded,
+                )),
+            )
+            anger_level, progress_level = analysis["anger"], analysis["progress"]
         else:
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))  # ダミータスク
-            
-        # 進捗度分析タスク
-        tasks.append(analyze_progress(updated_messages))
-
-        # すべてのタスクを並列実行
-        audio_data, anger_level, progress_level = await gather(*tasks)
+            audio_data, anger_level, progress_level = await gather(
+                speech,
+                anger_task,
+                timed("chat", "progress", with_deadline(
+                    "progress", progress_scorer(updated_messages), DEADLINE_PROGRESS_SECONDS, 50, degraded
+                )),
+            )
 
         # anger_levelがダミータスクだった場合のデフォルト値設定
         if isinstance(anger_level, type(None)):
             anger_level = 1
 
+        if not audio_data and "speech" not in degraded:
+            fallbacks.labels(stage="speech", reason="error").inc()
+        payload_bytes.labels(endpoint="chat", kind="audio").observe(len(audio_data))
+
+        # 音声はJSONに埋め込むか、IDだけ返して別エンドポイントから配信する
+        audio_id = None
+        if request.audio_delivery == "id" and audio_data:
+            audio_id = await offload(store_audio, audio_data, audio_encoding)
+            audio_data = b""
+
         return ChatResponse(
             response=response.text,
             point=anger_level,
             progress=progress_level,
-            audio=audio_data
+            audio=encode_audio(audio_data),
+            audio_id=audio_id,
+            audio_encoding=audio_encoding,
+            degraded=degraded,
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat generation: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    
+
+def chat_event(event_type: str, **fields) -> dict:
+    return {"type": event_type, **fields}
+
+def stream_event(event_type: str, **fields) -> bytes:
+    """
+    ストリーミング応答の1イベントをNDJSONの1行にする
+    """
+    return (json.dumps(chat_event(event_type, **fields), ensure_ascii=False) + "\n").encode("utf-8")
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    /chat のストリーミング版
+    NDJSON形式で text(差分)・point・progress・audio(文ごと)を準備できた順に返し、最後に done を返す
+    """
+    await require_model()
+    chat_model = get_chat_model(request.character)
+    # 受付枠はストリームの送信が終わるまで保持する
+    admitted = await generation_admission.acquire()
+
+    async def events():
+        try:
+            async with aclosing(chat_events(request, chat_model)) as chat_stream_events:
+                async for event in chat_stream_events:
+                    event_type = event.pop("type")
+                    if event_type == "audio":
+                        event["audio"] = encode_audio(event["audio"])
+                    yield stream_event(event_type, **event)
+        except HTTPException as e:
+            yield stream_event("error", detail=e.detail)
+        except Exception as e:
+            logger.error(f"Error in chat streaming: {e}")
+            yield stream_event("error", detail=str(e))
+        finally:
+            generation_admission.release(admitted)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+async def stream_reply(chat_model, prompt: str, temperature: Optional[float], usage: Optional[dict] = None):
+    """
+    応答テキストをストリーミングで生成し、差分を順に返す
+    usage を渡すと、上流APIが返したトークン数(prompt / output)を記録する
+    """
+    async for chunk in vertex_limit.stream(
+        chat_model.generate_content,
+        prompt,
+        generation_config={
+            "temperature": temperature,
+            "max_output_tokens": 1024,
+        },
+        stream=True,
+    ):
+        metadata = getattr(chunk, "usage_metadata", None)
+        if usage is not None and metadata is not None:
+            usage["prompt"] = getattr(metadata, "prompt_token_count", 0) or 0
+            usage["output"] = getattr(metadata, "candidates_token_count", 0) or 0
+        try:
+            delta = chunk.text
+        except ValueError:
+            # 安全性フィルタなどでテキストを含まないチャンク
+            continue
+        yield delta
+
+async def chat_events(request: ChatRequest, chat_model, reply: Optional[SpeculativeReply] = None):
+    """
+    text(差分)・point・progress・audio(文ごと)のイベントを準備できた順に返し、最後に done を返す
+    音声は合成したバイト列のまま返す(送信時の形式は呼び出し側で決める)
+    reply を渡すと、応答テキストを生成せずに先行生成した応答を使う
+    """
+    # 各処理が生成したイベントを届いた順に送信するためのキュー
+    queue: asyncio.Queue = asyncio.Queue()
+    audio_encoding = request.audio_encoding or DEFAULT_AUDIO_ENCODING
+    speech_pipeline = SpeechPipeline(audio_encoding)
+    tasks = []
+    degraded: List[str] = []
+
+    async def stream_text():
+        # テキスト応答を差分ごとに送信し、完結した文から音声合成を開始する
+        splitter = SentenceSplitter()
+        chunks = []
+
+        async def emit(deltas):
+            async for delta in deltas:
+                chunks.append(delta)
+                await queue.put(chat_event("text", delta=delta))
+                for sentence in splitter.feed(delta):
+                    speech_pipeline.add(sentence)
+
+        async def generate():
+            prompt = build_chat_prompt(request.messages)
+            if reply is not None:
+                try:
+                    await emit(reply.deltas())
+                except Exception as e:
+                    # 採用した先行生成が途中で失敗した場合は、送信済みのテキストの続きから生成し直す
+                    logger.warning(f"Speculative reply failed, generating afresh: {e}")
+                    count_speculation("fallback")
+                    await emit(stream_reply(chat_model, prompt + "".join(chunks), request.temperature))
+            else:
+                await emit(stream_reply(chat_model, prompt, request.temperature))
+
+        try:
+            # /chat と同じく、最初の差分が届くまでを含めた生成全体に期限を設ける
+            try:
+                await asyncio.wait_for(
+                    generate(), DEADLINE_GENERATION_SECONDS if DEADLINE_GENERATION_SECONDS > 0 else None
+                )
+            except asyncio.TimeoutError:
+                deadline_stats["generation_timeouts"] += 1
+                raise HTTPException(status_code=504, detail="Response generation timed out")
+            for sentence in splitter.flush():
+                speech_pipeline.add(sentence)
+        finally:
+            speech_pipeline.close()
+        return "".join(chunks)
+
+    async def send_analysis(text_task):
+        # combined モードでは応答後の1回の分析で point と progress を送る
+        response_text = await text_task
+        updated_messages = request.messages + [
+            Message(role="assistant", content=response_text)
+        ]
+        analysis = await with_deadline(
+            "analysis",
+            analyze_turn(request.messages, updated_messages),
+            max(DEADLINE_ANGER_SECONDS, DEADLINE_PROGRESS_SECONDS),
+            {"anger": 3, "progress": 50},
+            degraded,
+        )
+        await queue.put(chat_event("point", value=analysis["anger"]))
+        await queue.put(chat_event("progress", value=analysis["progress"]))
+
+    async def send_point():
+        anger_level = await with_deadline(
+            "anger", start_anger_task(request.messages), DEADLINE_ANGER_SECONDS, 3, degraded
+        )
+        # anger_levelがダミータスクだった場合のデフォルト値設定
+        if anger_level is None:
+            anger_level = 1
+        await queue.put(chat_event("point", value=anger_level))
+
+    async def send_audio():
+        # 文ごとの音声を順番どおりに送信する
+        index = 0
+        try:
+            async for segment in speech_pipeline.segments():
+                await queue.put(chat_event("audio", index=index, encoding=audio_encoding, audio=segment))
+                index += 1
+        except Exception as e:
+            logger.error(f"Error in speech generation: {e}")
+
+    async def send_progress(text_task):
+        response_text = await text_task
+        updated_messages = request.messages + [
+            Message(role="assistant", content=response_text)
+        ]
+        progress_level = await with_deadline(
+            "progress", analyze_progress(updated_messages), DEADLINE_PROGRESS_SECONDS, 50, degraded
+        )
+        await queue.put(chat_event("progress", value=progress_level))
+
+    tasks = []
+    all_done = None
+    getter = None
+    try:
+        text_task = asyncio.create_task(stream_text())
+        tasks = [text_task, asyncio.create_task(send_audio())]
+        if ANALYSIS_MODE == "combined":
+            tasks.append(asyncio.create_task(send_analysis(text_task)))
+        else:
+            tasks.append(asyncio.create_task(send_point()))
+            tasks.append(asyncio.create_task(send_progress(text_task)))
+        all_done = asyncio.gather(*tasks)
+        while not (all_done.done() and queue.empty()):
+            getter = asyncio.create_task(queue.get())
+            await asyncio.wait({getter, all_done}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        # 例外があればここで送出される
+        await all_done
+        yield chat_event("done", response=text_task.result(), degraded=degraded)
+    finally:
+        # クライアントが途中で切断した場合は残りの処理を止める
+        # 止める途中で送出された例外は既に送れないため、取り出して捨てる(未取得の警告を出さない)
+        if getter is not None:
+            getter.cancel()
+        for task in tasks:
+            task.cancel()
+        if all_done is not None:
+            all_done.cancel()
+            all_done.add_done_callback(lambda future: future.cancelled() or future.exception())
+        speech_pipeline.cancel()
+
+# WebSocket の接続後、認証フレームを待つ秒数と、メッセージが届かない場合に接続を閉じるまでの秒数
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", 10))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", 10 * 60))
+
+websocket_connections = metrics.Gauge("backend_websocket_connections", "接続中の /ws/chat の数")
+
+class WebSocketClosed(Exception):
+    """
+    認証の失敗・セッションの期限切れなどで接続を閉じる
+    """
+
+    def __init__(self, code: int, reason: str):
+        self.code = code
+        self.reason = reason
+
+async def authenticate_websocket(websocket: WebSocket):
+    """
+    接続時の Authorization ヘッダー、またはヘッダーを付けられないクライアント(ブラウザ)向けに
+    最初のフレーム {"type": "auth", "token": "..."} で認証する
+    """
+    if websocket.headers.get("Authorization") == f"Bearer {token}":
+        return
+    try:
+        frame = await asyncio.wait_for(websocket.receive_json(), WS_AUTH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise WebSocketClosed(status.WS_1008_POLICY_VIOLATION, "Authentication timed out")
+    except (ValueError, KeyError):
+        frame = None
+    if not (isinstance(frame, dict) and frame.get("type") == "auth" and frame.get("token") == token):
+        raise WebSocketClosed(status.WS_1008_POLICY_VIOLATION, "Invalid authentication token")
+
+def turn_request(frame: dict, history: List[Message], content: str) -> ChatRequest:
+    return ChatRequest(
+        messages=history + [Message(role="user", content=content)],
+        temperature=frame.get("temperature", 1.0),
+        character=frame.get("character"),
+        audio_encoding=frame.get("audio_encoding"),
+    )
+
+async def send_chat_events(websocket: WebSocket, request: ChatRequest,
+                           reply: Optional[SpeculativeReply] = None) -> str:
+    """
+    1回分の応答のイベントを準備できた順に送信し、応答テキストを返す
+    音声は {"type": "audio", ..., "bytes": n} を送った直後にバイナリフレームで送る
+    """
+    await require_model()
+    chat_model = get_chat_model(request.character)
+    response_text = ""
+    async with generation_admission.admit(), aclosing(chat_events(request, chat_model, reply)) as events:
+        with timed_stage("ws_chat", "turn"):
+            async for event in events:
+                if event["type"] == "audio":
+                    audio = event.pop("audio")
+                    await websocket.send_json({**event, "bytes": len(audio)})
+                    await websocket.send_bytes(audio)
+                    continue
+                if event["type"] == "done":
+                    response_text = event["response"]
+                await websocket.send_json(event)
+    return response_text
+
+async def websocket_chat(websocket: WebSocket):
+    """
+    接続ごとに会話履歴を保持し、ユーザーメッセージのフレームごとに応答を返す
+    クエリパラメーター session_id を指定すると、履歴を会話セッションに保存する(再接続後も続きから話せる)
+    SPECULATION=1 の場合、音声入力の途中の認識結果(interim フレーム)から応答を先行して生成する
+    """
+    await websocket.accept()
+    websocket_connections.labels().inc()
+    history: List[Message] = []
+    # 先行生成に使うモデルと temperature(直近の interim フレームの指定)
+    speculation_settings = None
+
+    def speculate(transcript: str) -> Optional[SpeculativeReply]:
+        # 生成の処理枠に空きがない場合は、実際のリクエストを優先して先行生成しない
+        if generation_admission.estimated_wait() > 0:
+            return None
+        chat_model, temperature = speculation_settings
+        prompt = build_chat_prompt(history + [Message(role="user", content=transcript)])
+        usage = {}
+        return SpeculativeReply(
+            transcript, stream_reply(chat_model, prompt, temperature, usage), usage,
+            settings=speculation_settings, prompt=prompt,
+        )
+
+    speculator = Speculator(speculate) if SPECULATION else None
+    try:
+        await authenticate_websocket(websocket)
+        session_id = websocket.query_params.get("session_id")
+        if session_id:
+            messages = await offload(session_store.get, session_id)
+            if messages is None:
+                raise WebSocketClosed(status.WS_1008_POLICY_VIOLATION, "Session not found")
+            history = [Message(**message) for message in messages]
+        await websocket.send_json(chat_event("ready", session_id=session_id, messages=len(history)))
+
+        while True:
+            try:
+                frame = await asyncio.wait_for(websocket.receive_json(), WS_IDLE_TIMEOUT_SECONDS or None)
+            except asyncio.TimeoutError:
+                raise WebSocketClosed(status.WS_1000_NORMAL_CLOSURE, "Idle timeout")
+            except (ValueError, KeyError):
+                # JSONでないテキストフレームやバイナリフレーム
+                await websocket.send_json(chat_event("error", detail="Frames must be JSON objects"))
+                continue
+            frame_type = frame.get("type") if isinstance(frame, dict) else None
+
+            if frame_type == "interim":
+                # 音声入力の途中の認識結果(先行生成が無効の場合や初期化中は何もしない)
+                if speculator is None or not upstreams_ready.is_set() or not isinstance(frame.get("content"), str):
+                    continue
+                try:
+                    request = turn_request(frame, history, frame["content"])
+                    speculation_settings = (get_chat_model(request.character), request.temperature)
+                except (ValidationError, HTTPException) as e:
+                    await websocket.send_json(chat_event("error", detail=str(e)))
+                    continue
+                speculator.interim(frame["content"])
+                continue
+            if frame_type == "reset":
+                history = []
+                if speculator:
+                    speculator.close()
+                if session_id:
+                    await offload(session_store.delete, session_id)
+                    session_id = await offload(session_store.create)
+                await websocket.send_json(chat_event("ready", session_id=session_id, messages=0))
+                continue
+            if frame_type != "message" or not isinstance(frame.get("content"), str):
+                await websocket.send_json(chat_event("error", detail="Unknown frame"))
+                continue
+
+            reply = None
+            try:
+                user_message = Message(role="user", content=frame["content"])
+                request = turn_request(frame, history, frame["content"])
+                if speculator:
+                    # 先行生成が最終結果と十分に近く、モデルと temperature も同じであればその応答を使う
+                    reply = speculator.final(
+                        frame["content"], (get_chat_model(request.character), request.temperature)
+                    )
+                response_text = await send_chat_events(websocket, request, reply)
+            except ValidationError as e:
+                await websocket.send_json(chat_event("error", detail=str(e)))
+                continue
+            except Overloaded as e:
+                await websocket.send_json(chat_event("error", detail="Server is busy", retry_after=e.retry_after))
+                continue
+            except HTTPException as e:
+                await websocket.send_json(chat_event("error", detail=e.detail))
+                continue
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logger.error(f"Error in websocket chat: {e}")
+                await websocket.send_json(chat_event("error", detail=str(e)))
+                continue
+            finally:
+                # 応答に使わなかった先行生成が残っていれば止める
+                if speculator:
+                    speculator.close()
+                if reply:
+                    reply.task.cancel()
+
+            # 応答が生成できた場合のみ履歴に追加する
+            exchange = [user_message, Message(role="assistant", content=response_text)]
+            history = (history + exchange)[-SESSION_MAX_MESSAGES:]
+            if session_id:
+                await offload(session_store.append, session_id, [message.model_dump() for message in exchange])
+    except WebSocketClosed as e:
+        await websocket.close(code=e.code, reason=e.reason)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if speculator:
+            speculator.close()
+        websocket_connections.labels().dec()
+
+# グローバルな verify_token(HTTPヘッダーのみ)を通さないルートとして登録し、接続後に認証する
+app.add_websocket_route("/ws/chat", websocket_chat)
+
+# 同じ会話履歴・temperatureに対する次のアクションの提案を保持する件数と秒数
+NEXT_ACTION_CACHE_MAX_ITEMS = int(os.getenv("NEXT_ACTION_CACHE_MAX_ITEMS", 1000))
+NEXT_ACTION_CACHE_TTL_SECONDS = int(os.getenv("NEXT_ACTION_CACHE_TTL_SECONDS", 10 * 60))
+next_action_cache = create_ttl_cache("next_action", NEXT_ACTION_CACHE_MAX_ITEMS, NEXT_ACTION_CACHE_TTL_SECONDS)
+# 同じ内容のリクエストが同時に届いた場合は1回の生成結果を共有する
+next_action_flight = SingleFlight()
+
 @app.post("/next-action", response_model=NextActionResponse)
+@traced("next_action")
 async def suggest_next_action(request: ChatRequest):
-    if not model:
-        raise HTTPException(status_code=503, detail="Vertex AI model not initialized")
-    
+    await require_model()
+
+    # combined モードで /chat の際に分析済みであれば、その結果を返す
+    if ANALYSIS_MODE == "combined":
+        prefetched = await offload(prefetched_actions.get, conversation_key(request.messages))
+        if prefetched:
+            action, reason = prefetched
+            return json_response("next_action", NextActionResponse(action=action, reason=reason))
+
+    # 画面の再表示やリトライで同じ会話履歴が送られてきた場合は生成済みの結果を返す
+    key = content_key(conversation_key(request.messages), request.temperature)
+    cached = await offload(next_action_cache.get, key)
+    if cached:
+        return json_response("next_action", cached)
+
+    async def generate():
+        async with generation_admission.admit():
+            response = await generate_next_action(request)
+        await offload(next_action_cache.put, key, response)
+        return response
+
+    return json_response("next_action", await next_action_flight.run(key, generate))
+
+async def generate_next_action(request: ChatRequest) -> NextActionResponse:
     try:
         # 会話履歴を分析するためのプロンプトを作成
         analysis_prompt = """
@@ -308,37 +1644,37 @@ async def suggest_next_action(request: ChatRequest):
         """
         
         # 会話履歴をフォーマット
-        conversation = "\n".join([
-            f"{'ユーザー' if msg.role == 'user' else 'アシスタント'}: {msg.content}" 
-            for msg in request.messages
-        ])
+        with timed_stage("next_action", "prompt"):
+            conversation = format_conversation(request.messages)
         
         # 次のアクションを生成
-        response = model.generate_content(
+        response = await timed("next_action", "generate", call_model(
+            "next_action",
             analysis_prompt + conversation,
             generation_config={
                 "temperature": request.temperature,
                 "max_output_tokens": 1024,
             },
-        )
+        ))
         
         # レスポンスをパースして構造化
-        response_text = response.text
-        action_parts = response_text.split('\n')
-        
-        action = ""
-        reason = ""
-        
-        for part in action_parts:
-            if part.startswith("アクション："):
-                action = part.replace("アクション：", "").strip()
-            elif part.startswith("理由："):
-                reason = part.replace("理由：", "").strip()
+        with timed_stage("next_action", "parse"):
+            response_text = response.text
+            action_parts = response_text.split('\n')
+            
+            action = ""
+            reason = ""
+            
+            for part in action_parts:
+                if part.startswith("アクション："):
+                    action = part.replace("アクション：", "").strip()
+                elif part.startswith("理由："):
+                    reason = part.replace("理由：", "").strip()
         
         if not action or not reason:
             # デフォルトの応答を設定
-            action = "状況の整理と冷静な分析"
-            reason = "現状をより明確に把握するため"
+            fallbacks.labels(stage="next_action", reason="unparsed").inc()
+            action, reason = DEFAULT_NEXT_ACTION
         
         return NextActionResponse(
             action=action,
@@ -349,9 +1685,95 @@ async def suggest_next_action(request: ChatRequest):
         logger.error(f"Error in next action suggestion: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def load_session(session_id: str) -> List[Message]:
+    history = await offload(session_store.get, session_id)
+    if history is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return [Message(**msg) for msg in history]
+
+@app.post("/sessions", response_model=SessionResponse)
+def create_session():
+    """
+    会話セッションを作成する
+    以降は /sessions/{session_id}/chat に新しいメッセージだけを送ればよい
+    """
+    return SessionResponse(session_id=session_store.create())
+
+@app.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_session(session_id: str):
+    session_store.delete(session_id)
+
+# 進捗度の評価方法 ("full": 毎回全履歴を評価 / "incremental": セッションの要約と直近のやりとりのみ評価)
+PROGRESS_MODE = os.getenv("PROGRESS_MODE", "full")
+# 要約に未反映のまま保持するメッセージ数の上限(要約の更新が失敗し続けても増え続けないように)
+PROGRESS_MAX_UNSUMMARIZED = int(os.getenv("PROGRESS_MAX_UNSUMMARIZED", 6))
+
+# 実行中のバックグラウンドタスク(完了前にGCされないよう参照を保持する)
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+@app.post("/sessions/{session_id}/chat", response_model=ChatResponse)
+@traced("chat")
+async def session_chat(session_id: str, request: SessionChatRequest):
+    history = await load_session(session_id)
+    user_message = Message(role="user", content=request.message)
+    chat_request = ChatRequest(
+        messages=history + [user_message],
+        temperature=request.temperature,
+        character=request.character,
+        audio_encoding=request.audio_encoding,
+        audio_delivery=request.audio_delivery,
+    )
+
+    async with generation_admission.admit():
+        # combined モードでは進捗度も1回の分析で評価するため、要約を使った評価(と要約の更新)は行わない
+        if PROGRESS_MODE != "incremental" or ANALYSIS_MODE == "combined":
+            response = await generate_chat(chat_request)
+        else:
+            meta = await offload(session_store.get_meta, session_id)
+
+            async def progress_scorer(updated_messages: List[Message]) -> int:
+                # 今回のユーザー発言と応答だけを要約と合わせて評価する
+                return await analyze_progress_incremental(meta, updated_messages[-2:])
+
+            response = await generate_chat(chat_request, progress_scorer)
+
+            # 今回のやりとりを通し番号を付けて要約待ちに追加し、要約の更新は応答を返した後に行う
+            meta = await offload(session_store.get_meta, session_id)
+            seq = meta.get("seq", 0)
+            meta["progress"] = response.progress
+            meta["seq"] = seq + 2
+            meta["unsummarized"] = (meta.get("unsummarized", []) + [
+                {**user_message.model_dump(), "seq": seq + 1},
+                {"role": "assistant", "content": response.response, "seq": seq + 2},
+            ])[-PROGRESS_MAX_UNSUMMARIZED:]
+            await offload(session_store.set_meta, session_id, meta)
+            run_in_background(update_progress_summary(session_id))
+
+    # 応答が生成できた場合のみ履歴に追加する
+    await offload(session_store.append, session_id, [
+        user_message.model_dump(),
+        {"role": "assistant", "content": response.response},
+    ])
+    return json_response("chat", response)
+
+@app.post("/sessions/{session_id}/next-action", response_model=NextActionResponse)
+async def session_next_action(session_id: str, request: SessionNextActionRequest):
+    history = await load_session(session_id)
+    return await suggest_next_action(ChatRequest(
+        messages=history,
+        temperature=request.temperature,
+    ))
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # 複数ワーカーの場合、uvicorn はアプリをインポート文字列で受け取る必要がある
+    uvicorn.run("main:app" if WORKERS > 1 else app, host="0.0.0.0", port=port, workers=WORKERS)
 
 
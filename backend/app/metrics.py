@@ -0,0 +1,227 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Prometheus のテキスト形式(0.0.4)で公開する
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    ラベルの組ごとに値を持つメトリクスの基底クラス
+    スレッドプールからも更新されるためロックで保護する
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children: Dict[Tuple[str, ...], object] = {}
+        registry.append(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Value:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return Value()
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {child.value}"
+            for key, child in list(self.children.items())
+        ]
+
+
+class Gauge(Counter):
+    """
+    値を直接更新するか、callback で出力時に値(ラベルの組 → 値)を取得する
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        if self.callback is None:
+            return super().samples()
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {value}"
+            for key, value in self.callback().items()
+        ]
+
+
+class HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, child in list(self.children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket = format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# アプリ全体で使うメトリクス
+request_seconds = Histogram(
+    "backend_http_request_seconds", "HTTPリクエストの処理時間", ("route", "status")
+)
+requests_in_flight = Gauge("backend_http_requests_in_flight", "処理中のHTTPリクエスト数")
+stage_seconds = Histogram(
+    "backend_stage_seconds", "エンドポイント内の処理段階ごとの所要時間", ("endpoint", "stage")
+)
+payload_bytes = Histogram(
+    "backend_payload_bytes", "レスポンス本体・音声データのサイズ", ("endpoint", "kind"), BYTES_BUCKETS
+)
+upstream_seconds = Histogram(
+    "backend_upstream_seconds", "上流API呼び出しの所要時間", ("task",)
+)
+upstream_errors = Counter("backend_upstream_errors_total", "上流API呼び出しの失敗回数", ("task",))
+fallbacks = Counter(
+    "backend_fallbacks_total", "エラーや期限切れでデフォルト値を返した回数", ("stage", "reason")
+)
+
+
+class MetricsMiddleware:
+    """
+    処理中のリクエスト数と、ルートごとの処理時間を記録するASGIミドルウェア
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        requests_in_flight.labels().inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.labels().dec()
+            # ルーティング後はパスパラメータを含まないルートのパスでまとめる
+            # (どのルートにも一致しなかったリクエストはパスごとに分けない)
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                route = scope["path"] if "endpoint" in scope else "unmatched"
+            request_seconds.labels(route=route, status=status["code"]).observe(time.perf_counter() - started)
+speculations = Counter(
+    "backend_speculation_total", "途中の認識結果から先行して応答を生成した回数(started / skipped / hit / miss / diverged / fallback)",
+    ("outcome",),
+)
+speculation_wasted_tokens = Counter(
+    "backend_speculation_wasted_tokens_total", "採用されなかった先行生成で消費したトークン数(上流APIが返す前に中止した場合は推定値)", ("kind",)
+)
+speculation_head_start_seconds = Histogram(
+    "backend_speculation_head_start_seconds", "採用された先行生成を、最終結果が届く何秒前に開始できたか"
+)
+model_seconds = Histogram(
+    "backend_model_seconds", "モデルごとのGemini呼び出しの所要時間(outcome: ok / error / timeout / cancelled)",
+    ("task", "model", "outcome"),
+)
+route_decisions = Counter(
+    "backend_route_decisions_total", "タスクごとに選んだモデルと選んだ理由(best / explore / fallback)",
+    ("task", "model", "reason"),
+)
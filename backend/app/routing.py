@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# モデルを振り分けるタスク(タスクごとに ROUTE_<TASK>_MODELS などで設定する)
+ROUTED_TASKS = ("chat", "anger", "progress", "next_action")
+# 観測したレイテンシとエラー率の指数移動平均の重み(大きいほど直近の結果を重視する)
+ROUTING_EWMA_ALPHA = float(os.getenv("ROUTING_EWMA_ALPHA", 0.2))
+# 最善ではないモデルをあえて選ぶ割合(回復したモデルの状態を知るため)
+ROUTING_EXPLORE_RATIO = float(os.getenv("ROUTING_EXPLORE_RATIO", 0.05))
+# 失敗(期限切れを含む)1回を何秒の遅延とみなしてモデルを比べるか
+ROUTING_ERROR_PENALTY_SECONDS = float(os.getenv("ROUTING_ERROR_PENALTY_SECONDS", 5))
+
+
+class TaskRoute:
+    """
+    タスクの候補モデル(先頭が優先)・1回の呼び出しの期限・生成設定の上書き
+    """
+
+    def __init__(self, task: str, models: List[str], timeout: float, config: dict):
+        self.task = task
+        self.models = models
+        self.timeout = timeout
+        self.config = config
+
+    def generation_config(self, generation_config):
+        # 上書きできるのは dict で渡された生成設定のみ
+        if self.config and isinstance(generation_config, dict):
+            return {**generation_config, **self.config}
+        return generation_config
+
+
+class ModelStats:
+    def __init__(self):
+        self.samples = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+
+    def record(self, latency: float, error: bool, alpha: float):
+        if self.samples == 0:
+            self.latency = latency
+            self.error_rate = float(error)
+        else:
+            self.latency += alpha * (latency - self.latency)
+            self.error_rate += alpha * (float(error) - self.error_rate)
+        self.samples += 1
+
+    def score(self, error_penalty: float) -> float:
+        # 失敗した場合は次の候補で呼び直すため、エラー率に応じて遅延を上乗せして比べる
+        return self.latency + self.error_rate * error_penalty
+
+
+class ModelRouter:
+    """
+    タスクごとに、観測したレイテンシとエラー率から最も速く結果を得られそうなモデルを選ぶ
+    まだ呼び出したことのないモデルは優先して試す(同じ場合は設定の順)
+    """
+
+    def __init__(self, routes: Dict[str, TaskRoute], alpha: float = ROUTING_EWMA_ALPHA,
+                 explore_ratio: float = ROUTING_EXPLORE_RATIO, error_penalty: float = ROUTING_ERROR_PENALTY_SECONDS,
+                 rng: Optional[random.Random] = None):
+        self.routes = routes
+        self.alpha = alpha
+        self.explore_ratio = explore_ratio
+        self.error_penalty = error_penalty
+        self.rng = rng or random.Random()
+        self.stats: Dict[Tuple[str, str], ModelStats] = {
+            (task, name): ModelStats() for task, route in routes.items() for name in route.models
+        }
+
+    def choose(self, task: str) -> Tuple[List[str], str]:
+        """
+        呼び出す順に並べた候補モデルと、先頭を選んだ理由(best / explore)を返す
+        """
+        route = self.routes[task]
+        ranked = sorted(
+            route.models,
+            key=lambda name: (self.stats[(task, name)].samples > 0,
+                              self.stats[(task, name)].score(self.error_penalty)),
+        )
+        if len(ranked) > 1 and self.rng.random() < self.explore_ratio:
+            explored = self.rng.choice(ranked[1:])
+            ranked.remove(explored)
+            return [explored] + ranked, "explore"
+        return ranked, "best"
+
+    def record(self, task: str, name: str, latency: float, error: bool):
+        self.stats[(task, name)].record(latency, error, self.alpha)
+
+    def snapshot(self) -> dict:
+        return {
+            task: {
+                "timeout": route.timeout,
+                "models": {
+                    name: {
+                        "samples": self.stats[(task, name)].samples,
+                        "latency_ms": round(self.stats[(task, name)].latency * 1000, 1),
+                        "error_rate": round(self.stats[(task, name)].error_rate, 3),
+                    }
+                    for name in route.models
+                },
+            }
+            for task, route in self.routes.items()
+        }
+
+
+def load_routes(default_model: str, deadlines: Optional[Dict[str, float]] = None) -> Dict[str, TaskRoute]:
+    """
+    環境変数からタスクごとの設定を読み込む
+    ROUTE_<TASK>_MODELS: 候補モデル(カンマ区切り、省略時は default_model のみ)
+    ROUTE_<TASK>_TIMEOUT_SECONDS: 1回の呼び出しの期限(過ぎたら次の候補で呼び直す、0 で無効)
+      省略時は、候補が複数あれば処理の期限(deadlines)を候補数で割った値、1つなら無効
+    ROUTE_<TASK>_CONFIG: 生成設定の上書き(JSON)
+    """
+    deadlines = deadlines or {}
+    routes = {}
+    for task in ROUTED_TASKS:
+        prefix = f"ROUTE_{task.upper()}"
+        models = [name.strip() for name in os.getenv(f"{prefix}_MODELS", default_model).split(",") if name.strip()]
+        models = models or [default_model]
+        deadline = deadlines.get(task, 0)
+        default_timeout = deadline / len(models) if len(models) > 1 and deadline > 0 else 0
+        timeout = float(os.getenv(f"{prefix}_TIMEOUT_SECONDS", default_timeout))
+        config = json.loads(os.getenv(f"{prefix}_CONFIG", "{}"))
+        routes[task] = TaskRoute(task, models, timeout, config)
+    return routes
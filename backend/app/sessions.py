@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from cache import WORKERS
+
+logger = logging.getLogger(__name__)
+
+# 会話セッションの保存先 ("memory": プロセス内のLRU / "sqlite": ローカルのSQLiteファイル)
+# 複数ワーカーで動かす場合は、どのワーカーでも同じセッションを読めるよう既定で sqlite にする
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite" if WORKERS > 1 else "memory")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "/tmp/sessions.sqlite3")
+# 最後に使われてからこの秒数が経過したセッションは破棄する
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 60 * 60))
+# 保持するセッション数の上限(超えた場合は最も古いものから破棄する)
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", 1000))
+# 1セッションあたりに保持するメッセージ数の上限(超えた場合は古い発言から捨てる)
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", 100))
+# 1セッションあたりに保持する発言の合計文字数の上限(超えた場合は古い発言から捨てる)
+# プロンプトには CONTEXT_TOKEN_BUDGET 程度の履歴(と古い発言の抜粋)しか使わないため、それを少し上回る程度にする
+SESSION_MAX_CHARS = int(os.getenv("SESSION_MAX_CHARS", 20_000))
+# 1発言あたりの文字数の上限(リクエストの検証に使う)
+MESSAGE_MAX_CHARS = int(os.getenv("MESSAGE_MAX_CHARS", 8000))
+
+
+def retained_count(lengths: List[int], max_messages: int, max_chars: int) -> int:
+    """
+    新しい順に並べた発言の文字数から、上限の範囲内で残す発言の数を返す(最新の発言は必ず残す)
+    """
+    total = 0
+    for count, length in enumerate(lengths[:max_messages]):
+        total += length
+        if count and total > max_chars:
+            return count
+    return min(len(lengths), max_messages)
+
+
+class SessionStore:
+    """
+    会話履歴の保存先のインターフェース
+    メッセージは {"role": ..., "content": ...} の辞書で扱う
+    """
+
+    def create(self) -> str:
+        raise NotImplementedError
+
+    def get(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        """
+        会話履歴を返す(存在しない、または期限切れの場合はNone)
+        """
+        raise NotImplementedError
+
+    def append(self, session_id: str, messages: List[Dict[str, str]]):
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def get_meta(self, session_id: str) -> dict:
+        """
+        セッションに付随する状態(要約や直近のスコアなど)を返す
+        """
+        raise NotImplementedError
+
+    def set_meta(self, session_id: str, meta: dict):
+        raise NotImplementedError
+
+    def snapshot(self) -> dict:
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内に会話履歴を保持する(単一インスタンス用)
+    セッション数・メッセージ数・文字数・TTLの上限でメモリ使用量を抑える
+    """
+
+    blocking = False
+
+    def __init__(self, ttl: int, max_count: int, max_messages: int, max_chars: int):
+        self.ttl = ttl
+        self.max_count = max_count
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.sessions: "OrderedDict[str, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def _expire(self, now: float):
+        # 古い順に並んでいるので、期限内のものが見つかった時点で止める
+        while self.sessions:
+            session_id, (updated_at, _, _) = next(iter(self.sessions.items()))
+            if now - updated_at < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+            self.evictions += 1
+
+    def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            self.sessions[session_id] = (now, [], {})
+            while len(self.sessions) > self.max_count:
+                self.sessions.popitem(last=False)
+                self.evictions += 1
+        return session_id
+
+    def get(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            self.sessions[session_id] = (now, entry[1], entry[2])
+            self.sessions.move_to_end(session_id)
+            return list(entry[1])
+
+    def append(self, session_id: str, messages: List[Dict[str, str]]):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return
+            history = entry[1] + messages
+            keep = retained_count(
+                [len(m["content"]) for m in reversed(history)], self.max_messages, self.max_chars
+            )
+            history = history[len(history) - keep:]
+            self.sessions[session_id] = (now, history, entry[2])
+            self.sessions.move_to_end(session_id)
+
+    def delete(self, session_id: str):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def get_meta(self, session_id: str) -> dict:
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            return dict(entry[2]) if entry else {}
+
+    def set_meta(self, session_id: str, meta: dict):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                self.sessions[session_id] = (entry[0], entry[1], dict(meta))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self.sessions),
+                "messages": sum(len(history) for _, history, _ in self.sessions.values()),
+                "evictions": self.evictions,
+            }
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLiteファイルに会話履歴を保持する
+    同じインスタンス内の複数プロセスから共有でき、再起動後も履歴が残る
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, ttl: int, max_count: int, max_messages: int, max_chars: int):
+        self.ttl = ttl
+        self.max_count = max_count
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL,
+                meta TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, seq);
+            """
+        )
+
+    def _cleanup(self, now: float):
+        # 期限切れのセッションと、上限を超えた古いセッションを削除する
+        self.conn.execute(
+            "DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM sessions WHERE id IN (
+                SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_count,),
+        )
+        self.conn.execute(
+            "DELETE FROM messages WHERE session_id NOT IN (SELECT id FROM sessions)"
+        )
+
+    def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT INTO sessions (id, updated_at) VALUES (?, ?)", (session_id, now)
+                )
+                self._cleanup(now)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return session_id
+
+    def get(self, session_id: str) -> Optional[List[Dict[str, str]]]:
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE sessions SET updated_at = ? WHERE id = ? AND updated_at >= ?",
+                (now, session_id, now - self.ttl),
+            )
+            if cursor.rowcount == 0:
+                return None
+            rows = self.conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append(self, session_id: str, messages: List[Dict[str, str]]):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(
+                    "UPDATE sessions SET updated_at = ? WHERE id = ?", (now, session_id)
+                )
+                if cursor.rowcount:
+                    self.conn.executemany(
+                        "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
+                        [(session_id, m["role"], m["content"]) for m in messages],
+                    )
+                    # 上限を超えた古いメッセージを削除する
+                    rows = self.conn.execute(
+                        "SELECT seq, length(content) FROM messages WHERE session_id = ? ORDER BY seq DESC",
+                        (session_id,),
+                    ).fetchall()
+                    keep = retained_count([length for _, length in rows], self.max_messages, self.max_chars)
+                    if keep < len(rows):
+                        self.conn.execute(
+                            "DELETE FROM messages WHERE session_id = ? AND seq <= ?",
+                            (session_id, rows[keep][0]),
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, session_id: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def get_meta(self, session_id: str) -> dict:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT meta FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def set_meta(self, session_id: str, meta: dict):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE sessions SET meta = ? WHERE id = ?",
+                (json.dumps(meta, ensure_ascii=False), session_id),
+            )
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            sessions = self.conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            messages = self.conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return {"backend": "sqlite", "sessions": sessions, "messages": messages}
+
+
+def create_session_store() -> SessionStore:
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore(
+            SESSION_SQLITE_PATH, SESSION_TTL_SECONDS, SESSION_MAX_COUNT, SESSION_MAX_MESSAGES, SESSION_MAX_CHARS
+        )
+    if SESSION_STORE != "memory":
+        logger.warning(f"Unknown SESSION_STORE '{SESSION_STORE}', using memory store")
+    return MemorySessionStore(SESSION_TTL_SECONDS, SESSION_MAX_COUNT, SESSION_MAX_MESSAGES, SESSION_MAX_CHARS)
+
+
+session_store = create_session_store()
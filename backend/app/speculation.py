@@ -0,0 +1,177 @@
+import asyncio
+import difflib
+import logging
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Callable, List, Optional, Set
+
+from context import estimate_tokens
+from metrics import speculation_head_start_seconds, speculation_wasted_tokens, speculations
+
+logger = logging.getLogger(__name__)
+
+# 音声入力の途中の認識結果から応答の生成を先行して開始するか
+SPECULATION = os.getenv("SPECULATION", "0") == "1"
+# 途中の認識結果がこの秒数変わらなければ生成を開始する(短いほど早く始まるが、外れて無駄になる生成が増える)
+SPECULATION_STABLE_SECONDS = float(os.getenv("SPECULATION_STABLE_SECONDS", 0.6))
+# この文字数に満たない認識結果では開始しない
+SPECULATION_MIN_CHARS = int(os.getenv("SPECULATION_MIN_CHARS", 4))
+# 最終結果との類似度(0〜1)がこの値以上であれば先行生成した応答を採用する
+SPECULATION_MATCH_RATIO = float(os.getenv("SPECULATION_MATCH_RATIO", 0.9))
+# プロセス全体で同時に先行生成する数の上限(超える場合は先行生成しない)
+SPECULATION_MAX_IN_FLIGHT = int(os.getenv("SPECULATION_MAX_IN_FLIGHT", 4))
+
+speculation_stats = {"started": 0, "skipped": 0, "hit": 0, "miss": 0, "diverged": 0, "fallback": 0,
+                     "wasted_prompt_tokens": 0, "wasted_output_tokens": 0}
+
+# 比較の際は空白と句読点の違いを無視する
+IGNORED_CHARS = re.compile(r"[\s、。，．,.！？!?「」]")
+
+
+def normalize(text: str) -> str:
+    return IGNORED_CHARS.sub("", text)
+
+
+def similarity(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, normalize(a), normalize(b)).ratio()
+
+
+def count(outcome: str):
+    speculation_stats[outcome] += 1
+    speculations.labels(outcome=outcome).inc()
+
+
+class SpeculativeReply:
+    """
+    途中の認識結果に対して先行して生成している応答
+    生成した差分を保持し、採用された場合は deltas() で最初から順に取り出せる
+    settings は生成に使った設定(モデル・temperature など)で、最終結果と同じ場合だけ採用する
+    prompt は上流APIがトークン数を返す前に中止した場合に、無駄になったトークン数を見積もるために使う
+    """
+
+    # 生成中の先行生成(プロセス全体)
+    running: Set["SpeculativeReply"] = set()
+
+    def __init__(self, transcript: str, deltas: AsyncIterator[str], usage: dict, settings: Any = None,
+                 prompt: str = ""):
+        self.transcript = transcript
+        self.settings = settings
+        self.prompt = prompt
+        # 上流APIが返したトークン数(prompt / output)、生成側で更新する
+        self.usage = usage
+        self.started = time.perf_counter()
+        self.chunks: List[str] = []
+        self.updated = asyncio.Event()
+        self.finished = False
+        self.error: Optional[Exception] = None
+        SpeculativeReply.running.add(self)
+        self.task = asyncio.create_task(self._consume(deltas))
+
+    async def _consume(self, deltas: AsyncIterator[str]):
+        try:
+            async for delta in deltas:
+                self.chunks.append(delta)
+                self.updated.set()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self.updated.set()
+            SpeculativeReply.running.discard(self)
+
+    async def deltas(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.finished:
+                if self.error:
+                    raise self.error
+                return
+            self.updated.clear()
+            await self.updated.wait()
+
+    def discard(self):
+        """
+        生成を中止し(ストリーミングの読み出しを止めて上流の生成も打ち切る)、消費したトークン数を無駄として記録する
+        """
+        def record_waste(_):
+            # トークン数は通常最後のチャンクで返るため、途中で中止した場合は受け取った分から見積もる
+            estimated = {"prompt": estimate_tokens(self.prompt), "output": estimate_tokens("".join(self.chunks))}
+            for kind in ("prompt", "output"):
+                tokens = self.usage.get(kind) or estimated[kind]
+                speculation_stats[f"wasted_{kind}_tokens"] += tokens
+                speculation_wasted_tokens.labels(kind=kind).inc(tokens)
+
+        self.task.add_done_callback(record_waste)
+        self.task.cancel()
+
+
+class Speculator:
+    """
+    接続ごとに途中の認識結果を受け取り、一定時間変わらなければ start(transcript) で応答の生成を開始する
+    start は混雑している場合などに None を返して先行生成を見送れる
+    最終結果が届いたら、先行生成の元になった認識結果と十分に近ければ採用し、そうでなければ中止する
+    """
+
+    def __init__(self, start: Callable[[str], Optional[SpeculativeReply]]):
+        self.start = start
+        self.transcript = ""
+        self.timer: Optional[asyncio.Task] = None
+        self.current: Optional[SpeculativeReply] = None
+
+    def interim(self, transcript: str):
+        if normalize(transcript) == normalize(self.transcript):
+            return
+        self.transcript = transcript
+        # 認識結果が先行生成の元から変わってしまった場合は中止する
+        if self.current and similarity(self.current.transcript, transcript) < SPECULATION_MATCH_RATIO:
+            count("diverged")
+            self.current.discard()
+            self.current = None
+        self._cancel_timer()
+        self.timer = asyncio.create_task(self._start_when_stable(transcript))
+
+    async def _start_when_stable(self, transcript: str):
+        await asyncio.sleep(SPECULATION_STABLE_SECONDS)
+        if self.current is not None or len(normalize(transcript)) < SPECULATION_MIN_CHARS:
+            return
+        reply = self.start(transcript) if len(SpeculativeReply.running) < SPECULATION_MAX_IN_FLIGHT else None
+        if reply is None:
+            count("skipped")
+            return
+        count("started")
+        self.current = reply
+
+    def final(self, transcript: str, settings: Any = None) -> Optional[SpeculativeReply]:
+        """
+        最終結果に対して採用できる先行生成を返す(なければ None)
+        settings が先行生成を開始した際と異なる場合は採用しない
+        """
+        self._cancel_timer()
+        self.transcript = ""
+        current, self.current = self.current, None
+        if current is None:
+            return None
+        if (current.error is None and current.settings == settings
+                and similarity(current.transcript, transcript) >= SPECULATION_MATCH_RATIO):
+            count("hit")
+            speculation_head_start_seconds.labels().observe(time.perf_counter() - current.started)
+            return current
+        count("miss")
+        current.discard()
+        return None
+
+    def close(self):
+        self._cancel_timer()
+        self.transcript = ""
+        if self.current:
+            self.current.discard()
+            self.current = None
+
+    def _cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
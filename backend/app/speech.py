@@ -0,0 +1,332 @@
+import asyncio
+import base64
+import hashlib
+import io
+import itertools
+import logging
+import os
+import re
+import wave
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from cache import content_key, create_audio_cache
+from cassette import cassette
+from tracing import set_attributes, span
+from upstream import tts_limit
+
+# Text-to-Speech のクライアントライブラリは読み込みに時間がかかるため、クライアントの作成時に読み込む
+if TYPE_CHECKING:
+    from google.cloud import texttospeech
+
+logger = logging.getLogger(__name__)
+
+# 文単位で並列に音声合成する際の同時リクエスト数
+TTS_SEGMENT_CONCURRENCY = int(os.getenv("TTS_SEGMENT_CONCURRENCY", 4))
+# 0 にすると応答全体を1リクエストで合成する(従来の動作)
+TTS_SENTENCE_PIPELINE = os.getenv("TTS_SENTENCE_PIPELINE", "1") != "0"
+
+# プロセス全体で共有するText-to-Speechクライアント(gRPCチャネル)の数
+TTS_CLIENT_POOL_SIZE = int(os.getenv("TTS_CLIENT_POOL_SIZE", 2))
+
+# 音声合成の設定(キャッシュキーにも使う)
+VOICE_SETTINGS = {
+    "language_code": "ja-JP",
+    "name": "ja-JP-Neural2-D",
+    "pitch": -8.0,
+    "speaking_rate": 1.3,
+    "effects_profile_id": ["small-bluetooth-speaker-class-device"],
+}
+
+# クライアントが選べる音声の形式と、配信時の拡張子・Content-Type
+AUDIO_ENCODINGS = {
+    "LINEAR16": ("wav", "audio/wav"),
+    "MP3": ("mp3", "audio/mpeg"),
+    "OGG_OPUS": ("ogg", "audio/ogg"),
+}
+# リクエストで指定がない場合の音声形式
+DEFAULT_AUDIO_ENCODING = os.getenv("TTS_AUDIO_ENCODING", "LINEAR16")
+
+# /audio/{audio_id} で配信する音声の保存領域(メモリ上のLRU)
+# 複数ワーカーの場合は、保存したワーカー以外にも取得リクエストが届くため共有キャッシュに置く
+AUDIO_STORE_MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", 16 * 1024 * 1024))
+audio_store = create_audio_cache("audio_store", AUDIO_STORE_MAX_BYTES)
+
+# 合成済み音声のキャッシュ(メモリは合計バイト数で上限を設ける)
+# TTS_CACHE_DIR を指定するとディスク上にも保存する
+# (Cloud Run のファイルシステムはメモリ上にあるため、メモリ上限と合わせて設定すること)
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR")
+TTS_CACHE_DISK_MAX_BYTES = int(os.getenv("TTS_CACHE_DISK_MAX_BYTES", 128 * 1024 * 1024))
+tts_cache = create_audio_cache("tts", TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR, TTS_CACHE_DISK_MAX_BYTES)
+
+# 日本語の文末(。！？)と半角の!?、改行で区切る
+SENTENCE_END = re.compile(r"[^。！？!?\n]*[。！？!?\n]+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    テキストを文末記号で文ごとに分割する(空白のみの文は除く)
+    """
+    splitter = SentenceSplitter()
+    sentences = splitter.feed(text)
+    sentences.extend(splitter.flush())
+    return sentences
+
+
+class SentenceSplitter:
+    """
+    ストリーミングで届くテキストから完結した文を順に取り出す
+    """
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, delta: str) -> List[str]:
+        self.buffer += delta
+        sentences = []
+        end = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            # 文末記号がバッファ末尾にある場合は、後続の記号(「！？」など)を待つ
+            if match.end() == len(self.buffer):
+                break
+            end = match.end()
+            if match.group().strip():
+                sentences.append(match.group().strip())
+        self.buffer = self.buffer[end:]
+        return sentences
+
+    def flush(self) -> List[str]:
+        sentences = [m.group().strip() for m in SENTENCE_END.finditer(self.buffer) if m.group().strip()]
+        rest = SENTENCE_END.sub("", self.buffer).strip()
+        if rest:
+            sentences.append(rest)
+        self.buffer = ""
+        return sentences
+
+
+tts_clients: List["texttospeech.TextToSpeechClient"] = []
+_tts_client_cycle = None
+
+
+def init_tts_clients(size: int = TTS_CLIENT_POOL_SIZE):
+    """
+    Text-to-Speechクライアントのプールを作成する
+    クライアントごとにgRPCチャネルを持つため、リクエスト間で使い回す
+    """
+    global tts_clients, _tts_client_cycle
+    if tts_clients or (cassette and cassette.mode == "replay"):
+        return
+    from google.cloud import texttospeech
+
+    tts_clients = [texttospeech.TextToSpeechClient() for _ in range(max(1, size))]
+    _tts_client_cycle = itertools.cycle(tts_clients)
+
+
+def get_tts_client() -> "texttospeech.TextToSpeechClient":
+    """
+    プールからクライアントをラウンドロビンで取り出す
+    """
+    if not tts_clients:
+        init_tts_clients()
+    return next(_tts_client_cycle)
+
+
+def warm_up_tts_clients():
+    """
+    各クライアントで音声一覧を取得し、チャネルの接続と認証トークンを準備しておく
+    """
+    for client in tts_clients:
+        client.list_voices(language_code="ja-JP")
+
+
+# Text-to-Speech機能を実装する関数
+def synthesize_speech(text: str, encoding: str = DEFAULT_AUDIO_ENCODING) -> bytes:
+    """
+    テキストを音声合成して音声データを返す(同期処理、スレッドプールから呼び出す)
+    同じテキストと音声設定の組はキャッシュから返す
+    """
+    key = content_key(text, VOICE_SETTINGS, encoding)
+    audio = tts_cache.get(key)
+    if audio is None:
+        if cassette:
+            audio = cassette.synthesize(request_speech, text, encoding, VOICE_SETTINGS)
+        else:
+            audio = request_speech(text, encoding)
+        tts_cache.put(key, audio)
+    return audio
+
+
+def request_speech(text: str, encoding: str = DEFAULT_AUDIO_ENCODING) -> bytes:
+    """
+    Text-to-Speech APIで音声合成する
+    """
+    from google.cloud import texttospeech
+
+    client = get_tts_client()
+
+    # 合成する入力テキストを設定
+    synthesis_input = texttospeech.SynthesisInput(text=text)
+
+    # 音声パラメータを設定
+    voice = texttospeech.VoiceSelectionParams(
+        language_code=VOICE_SETTINGS["language_code"],
+        name=VOICE_SETTINGS["name"]
+    )
+
+    # オーディオ設定
+    audio_config = texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding[encoding],
+        effects_profile_id=VOICE_SETTINGS["effects_profile_id"],
+        pitch=VOICE_SETTINGS["pitch"],
+        speaking_rate=VOICE_SETTINGS["speaking_rate"]
+    )
+
+    # リクエストを実行
+    response = client.synthesize_speech(
+        input=synthesis_input,
+        voice=voice,
+        audio_config=audio_config
+    )
+    return response.audio_content
+
+
+# 文ごとの音声セグメントを1つの音声に結合できるエンコーディング
+# MP3(ID3タグ付き)やOGG_OPUS(連結ストリーム)はそのまま連結すると再生できない端末があるため対象外
+MERGEABLE_ENCODINGS = {"LINEAR16"}
+
+
+def merge_segments(segments: List[bytes], encoding: str) -> bytes:
+    """
+    文ごとの音声セグメントを1つの音声に結合する
+    """
+    if len(segments) == 1:
+        return segments[0]
+    if encoding not in MERGEABLE_ENCODINGS:
+        raise ValueError(f"Cannot merge {encoding} segments")
+    return merge_wav_segments(segments)
+
+
+def merge_wav_segments(segments: List[bytes]) -> bytes:
+    """
+    LINEAR16(WAV)の音声セグメントを1つのWAVに結合する
+    WAVとして読めないセグメントが含まれる場合は単純に連結する
+    """
+    try:
+        params = None
+        frames = []
+        for segment in segments:
+            with wave.open(io.BytesIO(segment), "rb") as reader:
+                if params is None:
+                    params = reader.getparams()
+                frames.append(reader.readframes(reader.getnframes()))
+        output = io.BytesIO()
+        with wave.open(output, "wb") as writer:
+            writer.setparams(params)
+            writer.writeframes(b"".join(frames))
+        return output.getvalue()
+    except (wave.Error, EOFError):
+        return b"".join(segments)
+
+
+class SpeechPipeline:
+    """
+    文ごとに音声合成を開始し、同時実行数を制限しつつ順番どおりに結果を返す
+    テキスト生成のストリーミング中から文を追加できる
+    """
+
+    def __init__(self, encoding: str = DEFAULT_AUDIO_ENCODING, concurrency: int = TTS_SEGMENT_CONCURRENCY):
+        self.encoding = encoding
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks: List[asyncio.Task] = []
+        self.closed = asyncio.Event()
+        self.added = asyncio.Event()
+
+    async def _synthesize(self, sentence: str) -> bytes:
+        async with self.semaphore:
+            return await tts_limit.run(synthesize_speech, sentence, self.encoding)
+
+    def add(self, sentence: str):
+        self.tasks.append(asyncio.create_task(self._synthesize(sentence)))
+        self.added.set()
+
+    def close(self):
+        self.closed.set()
+        self.added.set()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def segments(self):
+        """
+        合成済みの音声セグメントを文の順番どおりに返す
+        """
+        index = 0
+        while True:
+            if index < len(self.tasks):
+                yield await self.tasks[index]
+                index += 1
+                continue
+            if self.closed.is_set():
+                return
+            self.added.clear()
+            await self.added.wait()
+
+    async def collect(self) -> bytes:
+        self.close()
+        return merge_segments([segment async for segment in self.segments()], self.encoding)
+
+
+def encode_audio(audio: bytes) -> str:
+    return base64.b64encode(audio).decode('utf-8')
+
+
+def store_audio(audio: bytes, encoding: str) -> str:
+    """
+    音声を保存して /audio/{audio_id} で配信するためのIDを返す
+    IDは内容のハッシュ値なので、同じ音声は同じIDになる
+    """
+    extension, _ = AUDIO_ENCODINGS[encoding]
+    audio_id = f"{hashlib.sha256(audio).hexdigest()}.{extension}"
+    audio_store.put(audio_id, audio)
+    return audio_id
+
+
+def load_audio(audio_id: str) -> Optional[Tuple[bytes, str]]:
+    """
+    保存した音声とContent-Typeを返す(見つからない場合はNone)
+    """
+    extension = audio_id.rsplit(".", 1)[-1]
+    media_types = {ext: media_type for ext, media_type in AUDIO_ENCODINGS.values()}
+    if extension not in media_types:
+        return None
+    audio = audio_store.get(audio_id)
+    if audio is None:
+        return None
+    return audio, media_types[extension]
+
+
+async def generate_speech(text: str, encoding: str = DEFAULT_AUDIO_ENCODING) -> bytes:
+    """
+    テキストを音声合成して音声データを返す(失敗時は空のバイト列)
+    1つの音声に結合できるエンコーディングの場合だけ文ごとに並列に合成する
+    """
+    try:
+        with span("tts.synthesize", text_chars=len(text), encoding=encoding) as current:
+            segmented = TTS_SENTENCE_PIPELINE and encoding in MERGEABLE_ENCODINGS
+            sentences = split_sentences(text) if segmented else []
+            if len(sentences) <= 1:
+                audio = await tts_limit.run(synthesize_speech, text, encoding)
+            else:
+                pipeline = SpeechPipeline(encoding)
+                for sentence in sentences:
+                    pipeline.add(sentence)
+                try:
+                    audio = await pipeline.collect()
+                finally:
+                    pipeline.cancel()
+            set_attributes(current, audio_bytes=len(audio), segments=max(len(sentences), 1))
+            return audio
+    except Exception as e:
+        logger.error(f"Error in speech generation: {e}")
+        return b""
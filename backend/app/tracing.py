@@ -0,0 +1,113 @@
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# OpenTelemetry のスパンの出力先(空: 出力しない / file: ファイルに JSON で追記 / otlp: コレクターに送信)
+# otlp の送信先は OTEL_EXPORTER_OTLP_ENDPOINT などの標準の環境変数で指定する
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces.jsonl")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "backend")
+
+tracer = None
+
+
+def init_tracing():
+    """
+    TRACE_EXPORTER に応じてスパンの出力先を設定する
+    opentelemetry-sdk がインストールされていない場合はスパンを出力しない
+    """
+    global tracer
+    if not TRACE_EXPORTER:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if TRACE_EXPORTER == "file":
+            out = open(TRACE_FILE_PATH, "a", encoding="utf-8")
+            exporter = ConsoleSpanExporter(
+                out=out, formatter=lambda span: span.to_json(indent=None) + "\n"
+            )
+        elif TRACE_EXPORTER == "otlp":
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            raise ValueError(f"Unknown TRACE_EXPORTER: {TRACE_EXPORTER}")
+
+        provider = TracerProvider(resource=Resource.create({"service.name": TRACE_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+        tracer = trace.get_tracer(__name__)
+        logger.info(f"Tracing enabled ({TRACE_EXPORTER})")
+    except (ImportError, ValueError) as e:
+        logger.warning(f"Tracing disabled: {e}")
+
+
+def shutdown_tracing():
+    if tracer is None:
+        return
+    from opentelemetry import trace
+    trace.get_tracer_provider().shutdown()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    スパンを開始する(トレースが無効な場合は None を返す)
+    """
+    if tracer is None:
+        yield None
+        return
+    with tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def set_attributes(current, **attributes):
+    if current is not None:
+        current.set_attributes(attributes)
+
+
+class ServerTiming:
+    """
+    1リクエスト内の処理段階ごとの所要時間(Server-Timing ヘッダー用)
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.entries: List[Tuple[str, float]] = []
+
+    def add(self, name: str, seconds: float):
+        self.entries.append((name, seconds))
+
+    def header(self) -> str:
+        entries = self.entries + [("total", time.perf_counter() - self.started)]
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in entries)
+
+
+# 処理中のリクエストの ServerTiming(asyncio のタスク間で引き継がれる)
+current_timing: ContextVar[Optional[ServerTiming]] = ContextVar("current_timing", default=None)
+
+
+def traced(endpoint: str):
+    """
+    エンドポイントの処理全体をスパンで囲み、処理段階の所要時間を集める
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            token = current_timing.set(ServerTiming())
+            try:
+                with span(endpoint):
+                    return await func(*args, **kwargs)
+            finally:
+                current_timing.reset(token)
+        return wrapper
+    return decorator
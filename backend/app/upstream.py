@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 上流API(Vertex AI / Text-to-Speech)の同期呼び出しを実行するスレッドプール
+# イベントループを塞がないよう、同期クライアントの呼び出しはすべてスレッドで実行する
+# (同時呼び出し数を制限する上流APIは UpstreamLimit ごとの専用のスレッドプールを使い、ここでは初期化などを実行する)
+UPSTREAM_MAX_WORKERS = int(os.getenv("UPSTREAM_MAX_WORKERS", 32))
+upstream_executor = ThreadPoolExecutor(
+    max_workers=UPSTREAM_MAX_WORKERS,
+    thread_name_prefix="upstream",
+)
+
+# 上流APIごとの同時呼び出し数の上限(0 で無制限)
+# 上限を超えた呼び出しはスレッドプールに入る前に待たせ、上流の遅延がスレッドを占有しないようにする
+VERTEX_MAX_CONCURRENCY = int(os.getenv("VERTEX_MAX_CONCURRENCY", 24))
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", 16))
+
+class UpstreamLimit:
+    """
+    上流APIの同時呼び出し数を制限し、専用のスレッドプールで実行する(run / stream で呼び出す)
+    枠は上流の呼び出しを実行しているスレッドが終わった時点で解放する
+    (期限切れなどで待っている側が取り消されても、スレッドが上流を呼び出している間は枠を使ったままにする)
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        # 上限と同じ数のスレッドを持ち、他の上流APIの呼び出しの後ろに並ばないようにする
+        self.executor = ThreadPoolExecutor(
+            max_workers=limit if limit > 0 else UPSTREAM_MAX_WORKERS,
+            thread_name_prefix=f"upstream-{name}",
+        )
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats = {"calls": 0, "waited": 0, "wait_ms_total": 0.0, "max_in_flight": 0}
+
+    async def acquire(self):
+        self.stats["calls"] += 1
+        if self.semaphore:
+            if self.semaphore.locked():
+                self.stats["waited"] += 1
+            started = time.perf_counter()
+            self.waiting += 1
+            try:
+                await self.semaphore.acquire()
+            finally:
+                self.waiting -= 1
+            self.stats["wait_ms_total"] += (time.perf_counter() - started) * 1000
+        self.in_flight += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+
+    def release(self):
+        self.in_flight -= 1
+        if self.semaphore:
+            self.semaphore.release()
+
+    def submit(self, func, *args, **kwargs) -> asyncio.Future:
+        """
+        確保済みの枠で func を専用のスレッドプールで実行する(枠は実行が終わった時点で解放する)
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(functools.partial(func, *args, **kwargs))
+        except Exception:
+            self.release()
+            raise
+
+        def release_when_done(_):
+            try:
+                loop.call_soon_threadsafe(self.release)
+            except RuntimeError:
+                # イベントループの終了後
+                pass
+
+        future.add_done_callback(release_when_done)
+        return asyncio.wrap_future(future, loop=loop)
+
+    async def run(self, func, *args, **kwargs):
+        await self.acquire()
+        return await self.submit(func, *args, **kwargs)
+
+    async def stream(self, func, *args, **kwargs):
+        """
+        同期的なストリーミング呼び出し(イテレータを返す関数)を枠の範囲で実行し、得られたチャンクを順に非同期で返す
+        """
+        await self.acquire()
+        async for chunk in iterate_in_thread(self.submit, func, *args, **kwargs):
+            yield chunk
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "limit": self.limit, "in_flight": self.in_flight, "waiting": self.waiting}
+
+async def run_upstream(func, *args, **kwargs):
+    """
+    同期的な上流API呼び出しをスレッドプールで実行し、完了を待つ
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        upstream_executor, functools.partial(func, *args, **kwargs)
+    )
+
+async def iterate_in_thread(submit, func, *args, **kwargs):
+    """
+    func(*args, **kwargs) が返すイテレータを submit(produce) で開始したスレッドで読み出し、チャンクを順に返す
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in func(*args, **kwargs):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, chunk)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, finished)
+
+    submit(produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # クライアント切断や期限切れで途中終了した場合は上流の読み出しも止める
+        # (次のチャンクを待っているスレッドの終了は待たない。同時呼び出し数の枠はスレッドの終了時に解放される)
+        stop.set()
+
+async def hedged(make_call, hedge_after: float, on_hedge=None):
+    """
+    make_call() の結果が hedge_after 秒以内に返らなければ同じ呼び出しをもう1つ開始し、
+    先に成功した方の結果を返す(hedge_after が 0 以下なら1回だけ呼び出す)
+    """
+    first = asyncio.create_task(make_call())
+    if hedge_after <= 0:
+        return await first
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            if on_hedge:
+                on_hedge()
+            tasks.add(asyncio.create_task(make_call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+vertex_limit = UpstreamLimit("vertex", VERTEX_MAX_CONCURRENCY)
+tts_limit = UpstreamLimit("tts", TTS_MAX_CONCURRENCY)
@@ -0,0 +1,110 @@
+"""
+ローカルの怒り度分類器を学習・評価し、Geminiによる評価と比較する
+
+    python bench/anger_calibrate.py                 # 学習用と評価用に分割して精度と確信度の閾値ごとの結果を出力
+    python bench/anger_calibrate.py --write-model   # コーパス全体で学習し app/anger_model.json を更新
+    python bench/anger_calibrate.py --gemini        # Gemini(既存のプロンプト)でも評価して比較する(要認証情報)
+
+コーパスは {"text": ..., "label": 1-5} のJSON Lines。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR / "app"))
+
+from anger_classifier import MODEL_PATH, train  # noqa: E402
+
+THRESHOLDS = [0.0, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+
+def load_corpus(path: Path):
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [(row["text"], int(row["label"])) for row in rows]
+
+
+def summarize(name: str, predictions, labels, latencies) -> dict:
+    n = len(labels)
+    return {
+        "scorer": name,
+        "samples": n,
+        "accuracy": round(sum(p == y for p, y in zip(predictions, labels)) / n, 3),
+        "within_1": round(sum(abs(p - y) <= 1 for p, y in zip(predictions, labels)) / n, 3),
+        "mae": round(sum(abs(p - y) for p, y in zip(predictions, labels)) / n, 3),
+        "latency_us_avg": round(sum(latencies) / n * 1e6, 1),
+    }
+
+
+def evaluate_local(classifier, samples) -> list:
+    results = []
+    for text, label in samples:
+        start = time.perf_counter()
+        level, confidence = classifier.predict(text)
+        results.append((level, confidence, label, time.perf_counter() - start))
+    return results
+
+
+async def evaluate_gemini(samples) -> list:
+    os.environ.setdefault("TOKEN", "bench")
+    os.environ["ANGER_SCORER"] = "llm"
+    import main
+
+    main.init_vertex_model()
+    results = []
+    for text, label in samples:
+        start = time.perf_counter()
+        level = await main.analyze_anger_level(text)
+        results.append((level, label, time.perf_counter() - start))
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--corpus", default=str(BACKEND_DIR / "bench" / "data" / "anger_corpus.jsonl"))
+    parser.add_argument("--holdout", type=float, default=0.25, help="評価に使う割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write-model", action="store_true", help="コーパス全体で学習してモデルファイルを更新する")
+    parser.add_argument("--gemini", action="store_true", help="Geminiでも評価する")
+    args = parser.parse_args()
+
+    samples = load_corpus(Path(args.corpus))
+    rng = random.Random(args.seed)
+    rng.shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train_samples, test_samples = samples[:split], samples[split:]
+
+    classifier = train(train_samples, seed=args.seed)
+    local = evaluate_local(classifier, test_samples)
+    labels = [label for _, _, label, _ in local]
+    print(json.dumps(summarize("local", [p for p, _, _, _ in local], labels, [t for *_, t in local])))
+
+    # 確信度の閾値ごとに、ローカルで確定する割合とその精度
+    for threshold in THRESHOLDS:
+        covered = [(p, y) for p, c, y, _ in local if c >= threshold]
+        print(json.dumps({
+            "scorer": "local",
+            "threshold": threshold,
+            "coverage": round(len(covered) / len(local), 3),
+            "accuracy_covered": round(sum(p == y for p, y in covered) / len(covered), 3) if covered else None,
+        }))
+
+    if args.gemini:
+        gemini = asyncio.run(evaluate_gemini(test_samples))
+        print(json.dumps(summarize(
+            "gemini", [p for p, _, _ in gemini], [y for _, y, _ in gemini], [t for *_, t in gemini]
+        )))
+
+    if args.write_model:
+        train(samples, seed=args.seed).save(MODEL_PATH)
+        print(json.dumps({"model": str(MODEL_PATH), "samples": len(samples)}))
+
+
+if __name__ == "__main__":
+    main_cli()
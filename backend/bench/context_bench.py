@@ -0,0 +1,72 @@
+"""
+会話履歴からプロンプトを作る処理のマイクロベンチマーク
+
+従来の += による全履歴の連結と、トークン数の上限付きの build_chat_prompt を
+10 / 100 / 1000 件の履歴で比較し、1回あたりの時間と推定トークン数をJSON行で出力する。
+    python bench/context_bench.py
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+os.environ.setdefault("TOKEN", "bench")
+
+import main  # noqa: E402
+from context import estimate_tokens  # noqa: E402
+from main import CHARACTERS, DEFAULT_CHARACTER, Message, build_chat_prompt, format_conversation  # noqa: E402
+
+USER_TURN = "また上司が締め切り直前に仕事を丸投げしてきて本当に腹が立つ。どうすればいいんだ。"
+ASSISTANT_TURN = "それはキツいな！まずは何をいつまでに頼まれたのか整理しようぜ。オマエが抱えてる量も一緒に書き出してみな。"
+
+
+def legacy_chat_prompt(messages):
+    # 変更前の /chat のプロンプト作成処理(キャラクター設定も毎回連結していた)
+    settings = CHARACTERS[DEFAULT_CHARACTER]
+    formatted_history = f"{settings['character']}\n{settings['format']}\n\n"
+    for msg in messages:
+        role_prefix = "User: " if msg.role == "user" else "Assistant: "
+        formatted_history += f"{role_prefix}{msg.content}\n"
+    formatted_history += "Assistant: "
+    return formatted_history
+
+
+def make_history(size: int):
+    return [
+        Message(role="user", content=USER_TURN) if i % 2 == 0 else Message(role="assistant", content=ASSISTANT_TURN)
+        for i in range(size)
+    ]
+
+
+def measure(func, messages, number: int) -> float:
+    return min(timeit.repeat(lambda: func(messages), number=number, repeat=5)) / number
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="10,100,1000")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    for size in map(int, args.sizes.split(",")):
+        messages = make_history(size)
+        for name, func in (
+            ("legacy_chat", legacy_chat_prompt),
+            ("chat", build_chat_prompt),
+            ("analysis", format_conversation),
+        ):
+            prompt = func(messages)
+            print(json.dumps({
+                "builder": name,
+                "messages": size,
+                "time_us": round(measure(func, messages, args.number) * 1e6, 1),
+                "prompt_chars": len(prompt),
+                "estimated_tokens": estimate_tokens(prompt),
+            }))
+
+
+if __name__ == "__main__":
+    main_cli()
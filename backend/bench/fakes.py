@@ -0,0 +1,170 @@
+"""
+ベンチマーク用の擬似 GenerativeModel / TextToSpeechClient
+
+遅延は分布の指定("fixed:0.3"・"uniform:0.1,0.5"・"lognormal:0.3,0.5"(中央値, σ))から毎回サンプリングする。
+プロンプトの内容(怒り度・進捗度・次のアクション・JSON)に応じて、本物と同じ形式の応答を返す。
+"""
+import io
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import wave
+
+SAMPLE_RATE = 24000
+
+
+class LatencyDistribution:
+    def __init__(self, spec: str, seed: int = 0):
+        kind, _, params = spec.partition(":")
+        values = [float(v) for v in params.split(",") if v]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self.spec = spec
+        self.kind = kind
+        self.values = values
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self.lock:
+            if self.kind == "fixed":
+                return self.values[0]
+            if self.kind == "uniform":
+                return self.rng.uniform(self.values[0], self.values[1])
+            median, sigma = self.values
+            return self.rng.lognormvariate(math.log(median), sigma)
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+REPLY_TEXT = "おう、どうした？まずは落ち着こうぜ。何があったのか、順番に話してみな！"
+
+
+class FakeGenerativeModel:
+    """
+    応答生成・分析の擬似モデル(応答生成は reply_chars 文字の文章を返す)
+    """
+
+    def __init__(self, latency: LatencyDistribution, reply_chars: int = 60, stream_chunks: int = 4):
+        self.latency = latency
+        self.reply_chars = reply_chars
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self.counter = itertools.count(1)
+
+    def reply(self, prompt: str) -> str:
+        if "JSON配列" in prompt:
+            count = len(re.findall(r"^\[\d+\]$", prompt, re.M))
+            return json.dumps([3] * count)
+        if "JSONで返して" in prompt:
+            return json.dumps({"anger": 3, "progress": 3, "action": "深呼吸する", "reason": "落ち着くため"}, ensure_ascii=False)
+        if "怒りの度合い" in prompt or "解決進捗度" in prompt:
+            return "3"
+        if "次に取るべき" in prompt:
+            return "アクション：深呼吸する\n理由：落ち着いて考えるため"
+        if "更新した要約" in prompt:
+            return "上司への不満を相談している。"
+        # 音声合成のキャッシュに当たらないよう、応答ごとに番号を付ける
+        text = (REPLY_TEXT * (self.reply_chars // len(REPLY_TEXT) + 1))[:self.reply_chars]
+        return f"{text}({next(self.counter)})"
+
+    def generate_content(self, prompt, generation_config=None, stream=False, **kwargs):
+        self.calls += 1
+        text = self.reply(prompt if isinstance(prompt, str) else str(prompt))
+        delay = self.latency.sample()
+        if not stream:
+            time.sleep(delay)
+            return FakeResponse(text)
+        return self.stream(text, delay)
+
+    def count_tokens(self, *args, **kwargs):
+        time.sleep(self.latency.sample())
+        return None
+
+    def stream(self, text: str, delay: float):
+        # 最初のチャンクまでに遅延の半分、残りを各チャンクに分けて返す
+        size = max(1, math.ceil(len(text) / self.stream_chunks))
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        time.sleep(delay / 2)
+        for chunk in chunks:
+            yield FakeResponse(chunk)
+            time.sleep(delay / 2 / len(chunks))
+
+
+def silent_wav(seconds: float) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\x00\x00" * int(SAMPLE_RATE * seconds))
+    return buffer.getvalue()
+
+
+class FakeAudioResponse:
+    def __init__(self, audio_content: bytes):
+        self.audio_content = audio_content
+
+
+class FakeTextToSpeechClient:
+    """
+    テキストの文字数に比例した長さの無音の音声を返す擬似クライアント
+    """
+
+    latency = LatencyDistribution("fixed:0.2")
+    seconds_per_char = 0.12
+    calls = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def list_voices(self, *args, **kwargs):
+        return []
+
+    def synthesize_speech(self, input=None, voice=None, audio_config=None, **kwargs):
+        cls = type(self)
+        cls.calls += 1
+        time.sleep(cls.latency.sample())
+        seconds = len(input.text) * cls.seconds_per_char
+        if audio_config is not None and audio_config.audio_encoding.name == "LINEAR16":
+            return FakeAudioResponse(silent_wav(seconds))
+        # MP3 / OGG_OPUS はおおよそ 32kbps 相当のサイズのダミーデータ
+        return FakeAudioResponse(b"\x00" * int(seconds * 4000))
+
+
+def install(main, gemini_latency: str, tts_latency: str, reply_chars: int = 60, seconds_per_char: float = 0.12,
+            seed: int = 0, import_sdk: bool = False) -> FakeGenerativeModel:
+    """
+    main モジュールの Vertex AI / Text-to-Speech のクライアントを擬似クライアントに差し替える
+    差し替えはアプリの起動時の初期化(init_vertex_model / init_tts_clients)で行う
+    import_sdk を指定すると、本番と同じく初期化時に Vertex AI SDK も読み込む(起動時間の計測用)
+    """
+    import speech
+
+    FakeTextToSpeechClient.latency = LatencyDistribution(tts_latency, seed + 1)
+    FakeTextToSpeechClient.seconds_per_char = seconds_per_char
+    fake = FakeGenerativeModel(LatencyDistribution(gemini_latency, seed), reply_chars)
+    init_tts_clients = speech.init_tts_clients
+
+    def init_vertex_model():
+        if import_sdk:
+            import vertexai.generative_models  # noqa: F401
+        main.model = fake
+        main.chat_models = {name: fake for name in main.CHARACTERS}
+
+    def init_fake_tts_clients(size: int = speech.TTS_CLIENT_POOL_SIZE):
+        from google.cloud import texttospeech
+
+        texttospeech.TextToSpeechClient = FakeTextToSpeechClient
+        init_tts_clients(size)
+
+    main.init_vertex_model = init_vertex_model
+    main.init_tts_clients = speech.init_tts_clients = init_fake_tts_clients
+    return fake
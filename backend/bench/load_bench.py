@@ -0,0 +1,167 @@
+"""
+/chat と /next-action に負荷をかけ、スループットとレイテンシを計測する
+
+Vertex AI と Text-to-Speech は呼ばず、遅延を指定できる擬似クライアント(bench/fakes.py)を使う。
+アプリはプロセス内で(ASGI で直接)呼び出すため、ネットワークやサーバーの起動は不要。
+    python bench/load_bench.py --concurrency 1,8,32 --duration 10
+    python bench/load_bench.py --endpoint next-action --gemini-latency lognormal:0.4,0.6 --output results.jsonl
+結果は同時実行数ごとに RPS・p50/p95/p99・ステータスごとの件数・メモリ使用量の最大値を JSON 行で出力する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "app"))
+sys.path.insert(0, str(BENCH_DIR))
+os.environ.setdefault("TOKEN", "bench")
+# 起動時のウォームアップは擬似クライアントでは不要
+os.environ.setdefault("UPSTREAM_WARMUP", "0")
+
+import httpx  # noqa: E402
+
+import fakes  # noqa: E402
+import main  # noqa: E402
+
+ENDPOINTS = {"chat": "/chat", "next-action": "/next-action"}
+USER_TURN = "また上司が締め切り直前に仕事を丸投げしてきて本当に腹が立つ。どうすればいいんだ。"
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def rss_mb() -> dict:
+    # ru_maxrss は Linux では KB 単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        current = None
+    return {"rss_mb": round(current, 1) if current else None, "rss_peak_mb": round(peak, 1)}
+
+
+def request_body(worker: int, sequence: int, history_turns: int, audio_delivery: str) -> dict:
+    # 次のアクションのキャッシュに当たらないよう、リクエストごとに内容を変える
+    messages = []
+    for turn in range(history_turns):
+        messages.append({"role": "user", "content": USER_TURN})
+        messages.append({"role": "assistant", "content": fakes.REPLY_TEXT})
+    messages.append({"role": "user", "content": f"{USER_TURN}({worker}-{sequence})"})
+    return {"messages": messages, "audio_delivery": audio_delivery}
+
+
+async def run_level(client: httpx.AsyncClient, path: str, concurrency: int, duration: float,
+                    history_turns: int, audio_delivery: str) -> dict:
+    latencies = []
+    statuses = {}
+    response_bytes = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(worker_id: int):
+        nonlocal response_bytes
+        sequence = 0
+        while time.perf_counter() < deadline:
+            sequence += 1
+            body = request_body(worker_id, sequence, history_turns, audio_delivery)
+            start = time.perf_counter()
+            response = await client.post(path, json=body)
+            elapsed = time.perf_counter() - start
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                latencies.append(elapsed)
+                response_bytes += len(response.content)
+            elif response.status_code == 429:
+                # 受付制御で断られた場合は Retry-After を待たずに少しだけ間を空ける
+                await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ok = len(latencies)
+    return {
+        "concurrency": concurrency,
+        "requests": sum(statuses.values()),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "rps": round(ok / wall, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        },
+        "response_bytes_avg": round(response_bytes / ok) if ok else 0,
+        **rss_mb(),
+    }
+
+
+async def run(args) -> list:
+    transport = httpx.ASGITransport(app=main.app)
+    headers = {"Authorization": f"Bearer {os.environ['TOKEN']}"}
+    rows = []
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers,
+                                     timeout=None) as client:
+            for endpoint in args.endpoint:
+                for concurrency in args.concurrency:
+                    result = await run_level(
+                        client, ENDPOINTS[endpoint], concurrency, args.duration,
+                        args.history_turns, args.audio_delivery,
+                    )
+                    row = {
+                        "endpoint": endpoint,
+                        **result,
+                        "gemini_latency": args.gemini_latency,
+                        "tts_latency": args.tts_latency,
+                    }
+                    print(json.dumps(row), flush=True)
+                    rows.append(row)
+    return rows
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--endpoint", default="chat,next-action",
+                        type=lambda v: v.split(","), help="chat / next-action(カンマ区切り)")
+    parser.add_argument("--concurrency", default="1,8,32",
+                        type=lambda v: [int(c) for c in v.split(",")], help="同時実行数(カンマ区切り)")
+    parser.add_argument("--duration", type=float, default=10, help="同時実行数ごとの計測時間(秒)")
+    parser.add_argument("--gemini-latency", default="lognormal:0.3,0.4",
+                        help="Gemini 呼び出しの遅延の分布(fixed:秒 / uniform:最小,最大 / lognormal:中央値,σ)")
+    parser.add_argument("--tts-latency", default="lognormal:0.2,0.3", help="音声合成の遅延の分布")
+    parser.add_argument("--reply-chars", type=int, default=60, help="応答の文字数")
+    parser.add_argument("--seconds-per-char", type=float, default=0.12, help="音声の長さ(1文字あたりの秒数)")
+    parser.add_argument("--history-turns", type=int, default=5, help="リクエストに含める過去のやりとりの数")
+    parser.add_argument("--audio-delivery", default="inline", choices=["inline", "id"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果を書き出すJSON Linesファイル")
+    args = parser.parse_args()
+
+    for endpoint in args.endpoint:
+        if endpoint not in ENDPOINTS:
+            parser.error(f"unknown endpoint: {endpoint}")
+
+    fakes.install(
+        main, args.gemini_latency, args.tts_latency,
+        reply_chars=args.reply_chars, seconds_per_char=args.seconds_per_char, seed=args.seed,
+    )
+    rows = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,121 @@
+"""
+進捗度評価のターンごとのレイテンシを、全履歴評価(full)と要約による差分評価(incremental)で比較する
+
+Vertex AI は呼ばず、プロンプトの文字数に比例して遅くなる擬似モデルを使う。
+    python bench/progress_bench.py --turns 50
+結果はターンごとのJSON行と、最初と最後の5ターンの平均を出力する。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+os.environ.setdefault("TOKEN", "bench")
+
+import main  # noqa: E402
+from main import Message  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeModel:
+    """
+    プロンプト1000文字あたり per_kchar 秒だけ遅くなる擬似モデル
+    """
+
+    def __init__(self, base: float, per_kchar: float):
+        self.base = base
+        self.per_kchar = per_kchar
+        self.prompt_chars = 0
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        self.prompt_chars += len(prompt)
+        time.sleep(self.base + self.per_kchar * len(prompt) / 1000)
+        if "要約" in prompt and "更新した要約" in prompt:
+            return FakeResponse("上司に仕事を押し付けられて怒っている。相談の仕方を一緒に考えている。")
+        return FakeResponse("3")
+
+
+USER_TURN = "また上司が締め切り直前に仕事を丸投げしてきて本当に腹が立つ。どうすればいいんだ。"
+ASSISTANT_TURN = "それはキツいな！まずは何をいつまでに頼まれたのか整理しようぜ。オマエが抱えてる量も一緒に書き出してみな。"
+
+
+async def run(mode: str, turns: int, fake: FakeModel) -> list:
+    session_id = main.session_store.create()
+    history = []
+    results = []
+    for turn in range(1, turns + 1):
+        exchange = [Message(role="user", content=USER_TURN), Message(role="assistant", content=ASSISTANT_TURN)]
+        history.extend(exchange)
+        chars_before = fake.prompt_chars
+        start = time.perf_counter()
+        if mode == "full":
+            await main.analyze_progress(history)
+        else:
+            meta = main.session_store.get_meta(session_id)
+            progress = await main.analyze_progress_incremental(meta, exchange)
+            seq = meta.get("seq", 0)
+            meta["progress"] = progress
+            meta["seq"] = seq + len(exchange)
+            meta["unsummarized"] = (meta.get("unsummarized", []) + [
+                {**m.model_dump(), "seq": seq + i} for i, m in enumerate(exchange, 1)
+            ])[-main.PROGRESS_MAX_UNSUMMARIZED:]
+            main.session_store.set_meta(session_id, meta)
+        latency = time.perf_counter() - start
+        results.append({
+            "mode": mode,
+            "turn": turn,
+            "latency_ms": round(latency * 1000, 2),
+            "prompt_chars": fake.prompt_chars - chars_before,
+        })
+        if mode == "incremental":
+            # 本番と同様に要約の更新はレイテンシの計測外で行う
+            await main.update_progress_summary(session_id)
+    return results
+
+
+def average(rows, key):
+    return round(sum(r[key] for r in rows) / len(rows), 2)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--base-latency", type=float, default=0.05, help="1呼び出しあたりの固定遅延(秒)")
+    parser.add_argument("--per-kchar", type=float, default=0.01, help="プロンプト1000文字あたりの追加遅延(秒)")
+    parser.add_argument("--output", help="ターンごとの結果を書き出すJSON Linesファイル")
+    args = parser.parse_args()
+
+    fake = FakeModel(args.base_latency, args.per_kchar)
+    main.model = fake
+
+    rows = []
+    for mode in ("full", "incremental"):
+        rows.extend(asyncio.run(run(mode, args.turns, fake)))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+    for mode in ("full", "incremental"):
+        mode_rows = [r for r in rows if r["mode"] == mode]
+        print(json.dumps({
+            "mode": mode,
+            "turns": len(mode_rows),
+            "first5_latency_ms": average(mode_rows[:5], "latency_ms"),
+            "last5_latency_ms": average(mode_rows[-5:], "latency_ms"),
+            "first5_prompt_chars": average(mode_rows[:5], "prompt_chars"),
+            "last5_prompt_chars": average(mode_rows[-5:], "prompt_chars"),
+        }))
+
+
+if __name__ == "__main__":
+    main_cli()
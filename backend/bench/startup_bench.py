@@ -0,0 +1,134 @@
+"""
+バックエンドの起動時間を計測する
+
+    python bench/startup_bench.py --repeat 3
+次の値を JSON 行で出力する。
+- import: `import main` にかかる時間
+- 起動方式(STARTUP_BACKGROUND_INIT=1 / 0)ごとに、プロセスの起動から
+  リクエストを受け付けるまで(listen)・/ready が 200 を返すまで(ready)・最初の /chat が返るまで(first_chat)の時間
+Vertex AI と Text-to-Speech は擬似クライアント(bench/fakes.py)を使うが、SDK の読み込みは本番と同じく初期化時に行う。
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+APP_DIR = BENCH_DIR.parent / "app"
+TOKEN = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def child_env(**extra) -> dict:
+    return {**os.environ, "TOKEN": TOKEN, "PYTHONPATH": f"{APP_DIR}{os.pathsep}{BENCH_DIR}", **extra}
+
+
+def measure_import() -> float:
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=APP_DIR, env=child_env(), capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def measure_startup(background: bool, args) -> dict:
+    import httpx
+
+    port = free_port()
+    env = child_env(STARTUP_BACKGROUND_INIT="1" if background else "0")
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve()), "--serve", "--port", str(port),
+         "--gemini-latency", args.gemini_latency, "--tts-latency", args.tts_latency],
+        cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {"background_init": background}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            # 接続できるまで待つ
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError("server exited during startup")
+                try:
+                    ready = client.get("/ready")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.005)
+            result["listen_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+            # 受け付け開始直後に最初のリクエストを送る(初期化中であれば完了まで待たされる)
+            response = client.post(
+                "/chat",
+                json={"messages": [{"role": "user", "content": "こんにちは"}]},
+                headers={"Authorization": f"Bearer {TOKEN}"},
+            )
+            result["first_chat_status"] = response.status_code
+            result["first_chat_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+            while ready.status_code != 200:
+                time.sleep(0.005)
+                ready = client.get("/ready")
+            result["ready_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            result["init_ms"] = ready.json().get("init_ms")
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def serve(args):
+    os.environ.setdefault("UPSTREAM_WARMUP", "1")
+    import uvicorn
+
+    import fakes
+    import main
+
+    fakes.install(main, args.gemini_latency, args.tts_latency, import_sdk=True)
+    uvicorn.run(main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--gemini-latency", default="fixed:0.3")
+    parser.add_argument("--tts-latency", default="fixed:0.2")
+    parser.add_argument("--output", help="結果を書き出すJSON Linesファイル")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    rows = []
+    imports = [measure_import() for _ in range(args.repeat)]
+    rows.append({"phase": "import", "import_ms": round(statistics.median(imports) * 1000, 1)})
+    for background in (True, False):
+        runs = [measure_startup(background, args) for _ in range(args.repeat)]
+        row = {"phase": "startup", "background_init": background}
+        for key in ("listen_ms", "first_chat_ms", "ready_ms", "init_ms"):
+            row[key] = round(statistics.median(run[key] for run in runs), 1)
+        row["first_chat_status"] = [run["first_chat_status"] for run in runs]
+        rows.append(row)
+
+    for row in rows:
+        print(json.dumps(row))
+    if args.output:
+        with open(args.output, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main_cli()
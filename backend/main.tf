@@ -70,12 +70,14 @@ resource "google_cloud_run_service" "my_service" {
           }
         }
 
+        # 上流APIのクライアントの初期化が終わるまでトラフィックを流さない
         startup_probe {
-          initial_delay_seconds = 10
+          initial_delay_seconds = 0
           timeout_seconds       = 1
-          period_seconds        = 3
-          failure_threshold     = 3
-          tcp_socket {
+          period_seconds        = 1
+          failure_threshold     = 30
+          http_get {
+            path = "/ready"
             port = 8080
           }
         }
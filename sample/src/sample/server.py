@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
@@ -8,7 +9,24 @@ import signal
 import sys
 from typing import Generator
 
-app = FastAPI()
+# Text-to-Speechクライアントは起動時に1回だけ作成し、全接続で共有する
+tts_client = None
+
+def init_tts_client():
+    global tts_client
+    tts_client = texttospeech.TextToSpeechClient()
+    # 音声一覧を取得してgRPCチャネルと認証トークンを準備しておく
+    try:
+        tts_client.list_voices(language_code="ja-JP")
+    except Exception as e:
+        print(f"Text-to-speech warm-up error: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_tts_client()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -46,7 +64,7 @@ def create_streaming_config():
 
 def text_to_speech(text: str) -> bytes:
     """テキストを音声に変換する"""
-    client = texttospeech.TextToSpeechClient()
+    client = tts_client or texttospeech.TextToSpeechClient()
     
     synthesis_input = texttospeech.SynthesisInput(text=text)
     